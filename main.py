@@ -1,4 +1,6 @@
+import codecs
 import glob
+import io
 import os
 import subprocess
 import sys
@@ -8,8 +10,6 @@ import re
 from collections import namedtuple
 from contextlib import contextmanager
 
-from PIL import Image
-
 
 # TODO: traverse \usepackage to check local packages
 # TODO: don't continue recursion after \end{document}
@@ -141,6 +141,7 @@ class Copier(object):
         self.encodings = encodings
         self.convert_to_jpg = convert_to_jpg
         self.commands = {}  # command_name -> command
+        self.file_encodings = {}  # latex_file_p -> encoding
         self.command_regexes = []
 
     def copy_all(self, latex_file_p, current_dir):
@@ -148,14 +149,14 @@ class Copier(object):
         Recursively parse file at `latex_file_p`.
         """
         self.copy(current_dir, latex_file_p)
-        for encoding in self.encodings:
-            try:
-                self._read_and_copy(current_dir, latex_file_p, encoding)
-                break  # successfully read
-            except UnicodeDecodeError as e:   # TODO: always unicode error?
-                print('Error while reading {} with {}: {}'.format(latex_file_p, encoding, e))
-        else:  # no-break, i.e., never sucessfully read
+        with open(latex_file_p, 'rb') as f:
+            data = f.read()
+        encoding = self.file_encodings.get(latex_file_p) or _detect_encoding(data, self.encodings, latex_file_p)
+        if encoding is None:
             print('ERR: Unable to read {} with encodings {}. Pass --encodings'.format(latex_file_p, self.encodings))
+            return
+        self.file_encodings[latex_file_p] = encoding
+        self._read_and_copy(current_dir, latex_file_p, data.decode(encoding))
 
     def _consume_and_parse_newcommand(self, current_line, file_iter):
         m = _RE_NEWCOMMAND.search(current_line)
@@ -193,15 +194,15 @@ class Copier(object):
                 included_paths = Copier._included_source_file()
         return res
 
-    def _read_and_copy(self, current_dir, latex_file_p, encoding):
+    def _read_and_copy(self, current_dir, latex_file_p, text):
         """
         Copy file `latex_file_p` and refered images, recursively copy all files included via \input
         :param current_dir: current directory, where images are searched
         :param latex_file_p: file to be parsed, full file path!
-        :raise UnicodeDecodeError if file is in wrong encoding
+        :param text: decoded contents of `latex_file_p`
         """
         print(latex_file_p)
-        with open(latex_file_p, 'r', encoding=encoding) as f:
+        with io.StringIO(text, newline=None) as f:
             f_iter = enumerate(f)
             for line_number, l in f_iter:
                 if l.strip().startswith('%'):  # comment
@@ -289,6 +290,7 @@ class Copier(object):
                                p_name, p_name, os.path.splitext(p_name)[0]))
             out_p = out_p.replace('.png', '.jpg')
             os.makedirs(os.path.dirname(out_p), exist_ok=True)
+            from PIL import Image  # Only needed for --convert_to_jpg.
             Image.open(p).save(out_p, quality=95)
             print('Converted!', out_p)
         else:
@@ -400,6 +402,22 @@ def assert_exc(cond, msg=None, exc=ValueError):
         raise exc(msg)
 
 
+def _detect_encoding(data, encodings, p):
+    """ Detect encoding of `data`: check for a BOM, then for valid UTF-8, then try `encodings`. None if all fail. """
+    for bom, encoding in [(codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'),
+                          (codecs.BOM_UTF8, 'utf-8-sig'),
+                          (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')]:
+        if data.startswith(bom):
+            return encoding
+    for encoding in ['utf-8'] + list(encodings):
+        try:
+            data.decode(encoding)
+            return encoding
+        except UnicodeDecodeError as e:
+            print('Error while reading {} with {}: {}'.format(p, encoding, e))
+    return None
+
+
 def _rmtree_semi_safe(out_dir, max_size_mb=20):
     assert_exc(_get_size(out_dir, max_size_mb * 1024 * 1024) is not None,
                'Will not rm -rf {}, too big. Please delete manually.'.format(out_dir))
@@ -458,7 +476,8 @@ def main(args=sys.argv[1:]):
     p.add_argument('--out_dir', '-o', help='Where to store files.')
     p.add_argument('--rename', '-mv',
                    help='If given, rename OUT_DIR/MAIN_FILE to OUT_DIR/NEW_NAME', metavar='NEW_NAME')
-    p.add_argument('--encodings', default=['utf-8'], nargs='+', help='Encodings to try when opening .tex files')
+    p.add_argument('--encodings', default=['utf-8'], nargs='+',
+                   help='Encodings to try when opening .tex files, after checking for a BOM and UTF-8.')
     p.add_argument('--force', '-f', action='store_true', help='If given, delete and re-create OUT_DIR. '
                                                               'WARNING: Calls rm -rf OUT_DIR.')
     p.add_argument('--store_git_hash', '-git', action='store_true',
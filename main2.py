@@ -13,20 +13,28 @@ Note: includes are assumed to be relative to root!
 
 """
 import argparse
+import codecs
+import copy
+import fnmatch
 import glob
+import hashlib
+import io
+import math
 import os
 import re
 import shutil
 import sys
-from collections import namedtuple
+import threading
+import time
+from collections import namedtuple, OrderedDict
 from contextlib import contextmanager
 import subprocess
 
-from fjcommon.assertions import assert_exc
+# Note: keep imports at the top cheap, such that `--help` is fast. Heavy or optional dependencies (and modules only
+# needed for some modes, such as tempfile or concurrent.futures) are imported where they are used.
 
 # TODO: assumes latexmk exists!
 # TODO: renewcommand
-# TODO: detect loops in usepackage
 # TODO: JPG Conversion is not implemented
 # - return (path_in_tex, path_on_disk)  (make sure only one path matching latex on disk)
 # - have IMG_EXTS = {...}, STATIC_EXTS = IMG_EXTS | {.pdf}
@@ -34,10 +42,13 @@ from fjcommon.assertions import assert_exc
 
 
 class IncludeCommand(object):
-    def __init__(self, regex, path_group, possible_extensions=None, needs_parse=False, must_exist=True):
+    def __init__(self, regex, path_group, possible_extensions=None, needs_parse=False, must_exist=True,
+                 body_only=False):
         """
         :param regex: The regex that matches an include command
         :param path_group: The group of the regex that matches the path of the included file
+        :param body_only: Only relevant for --flatten: if True, only the part of the included file between
+            \\begin{document} and \\end{document} is inlined (e.g. for \\subfile).
         Example:
             IncludeCommand(r'\\includegraphics(\[.*\])?{(.*?)}', path_group=2, ...)
             Here, path_group=2 because the first group matches the optional arguments of includegraphics
@@ -50,14 +61,47 @@ class IncludeCommand(object):
         self.possible_extensions = possible_extensions
         self.needs_parse = needs_parse
         self.must_exist = must_exist
+        self.body_only = body_only
 
 
 # TODO: rename real_path, it's real_rel or sth!
-StaticFile = namedtuple('StaticFile', ['tex_path', 'real_path'])  # real_path is also relative
+# options: the optional arguments, e.g., '[page=3]', command: the complete include command as matched.
+StaticFile = namedtuple('StaticFile', ['tex_path', 'real_path', 'options', 'command'],
+                        defaults=(None, None))  # real_path is also relative
 TexFile = namedtuple('TexFile', ['real_rel_path', 'needs_parse'])  # real_path is also relative
+# An edge of the include graph: `file` (TexFile or StaticFile) is included within the environments `envs`.
+Dependency = namedtuple('Dependency', ['file', 'envs'])
+
+# An output bundle derived from the same parse, see `Copier.copy_variant`.
+# name: name of the variant, e.g., used as directory name.
+# main_file: main file of the variant, relative to the LaTeX project.
+# strip_envs: environments that are removed from the output, including everything included within them.
+# jpg_exts: extensions of images that are converted to .jpg, e.g., ('.png',).
+# jpg_quality: quality used when converting to .jpg.
+# rename: like --rename.
+Variant = namedtuple('Variant', ['name', 'main_file', 'strip_envs', 'jpg_exts', 'jpg_quality', 'rename'],
+                     defaults=((), (), 95, None))
 
 
 _END_DOCUMENT_MARKER = '\\end{document}'
+_BEGIN_DOCUMENT_MARKER = '\\begin{document}'
+
+# Modification time of all members of the output tar, see write_tar. 1980-01-01, like zip files.
+_TAR_MTIME = 315532800
+
+# Default location of precompiled preambles, see _FormatCache.
+_FMT_CACHE_DIR = os.path.join('~', '.cache', 'arxiv_prep', 'fmt')
+
+# Default location and size of the cache of converted images and PDFs, see _AssetCache.
+_ASSET_CACHE_DIR = os.path.join('~', '.cache', 'arxiv_prep', 'assets')
+_ASSET_CACHE_MAX_MB = 1024
+
+# Default location of preamble snapshots, see _PreambleCache. Bump the version when the snapshot format changes.
+_PREAMBLE_CACHE_DIR = os.path.join('~', '.cache', 'arxiv_prep', 'preamble')
+_PREAMBLE_SNAPSHOT_VERSION = 3
+
+# ioctl to create a copy-on-write clone of a file (Linux, e.g., btrfs and XFS), see _link_or_copy.
+_FICLONE = 0x40049409
 
 
 # We call images or PDFs "static", as they do not need to be parsed.
@@ -72,15 +116,26 @@ _STATIC_INCLUDES = [
 ]
 
 
+_INPUT_INCLUDE = IncludeCommand(r'\\input{(.*?)}', 1, {'.tex'}, needs_parse=True)
+_SUBFILE_INCLUDE = IncludeCommand(r'\\subfile{(.*?)}', 1, {'.tex'}, needs_parse=True, body_only=True)
+
+# Includes that are expanded in place with --flatten.
+_INLINE_INCLUDES = [_INPUT_INCLUDE, _SUBFILE_INCLUDE]
+
 _TEX_INCLUDES = [
-    IncludeCommand(r'\\input{(.*?)}', 1, {'.tex'}, needs_parse=True),
-    IncludeCommand(r'\\subfile{(.*?)}', 1, {'.tex'}, needs_parse=True),
+    _INPUT_INCLUDE,
+    _SUBFILE_INCLUDE,
     IncludeCommand(r'\\usepackage(\[.*?\])?{(.*?)}', 2, {'.sty'}, needs_parse=True, must_exist=False),
     IncludeCommand(r'\\bibliographystyle{(.*?)}', 1, {'.bst'}, needs_parse=False),
     IncludeCommand(r'\\bibliography{(.*?)}', 1, {'.bib'}, needs_parse=False),
 ]
 
+# Names of the commands in _TEX_INCLUDES, e.g., \input, see Copier._scan_definitions.
+_TEX_INCLUDE_NAMES = ['\\' + re.match(r'\\\\(\w+)', c.regex.pattern).group(1) for c in _TEX_INCLUDES]
+
 _RE_NEWCOMMAND = re.compile(r'\\(re)?newcommand\*?{?(.*?)}?(\[(\d+)\])?{')
+_RE_ENVIRONMENT = re.compile(r'\\(begin|end){(.*?)}')
+_RE_PAGE_OPTION = re.compile(r'page\s*=\s*([^,\]]*)')
 
 
 class ParseException(Exception):
@@ -89,40 +144,127 @@ class ParseException(Exception):
 
 def copy_latex(flags):
     """Main function."""
-    c = Copier(flags.encodings, flags.main_file, flags.out_dir)
-    main_file_out = c.copy(flags.store_git_hash, flags.rename)
-    sizes = c.copied_file_sizes()
-    print('Biggest files:')
-    print('\n'.join('{}kB: {}'.format(s, p) for s, p in sorted(sizes, reverse=True)[:10]))
-    print('Total: {}kB'.format(sum(s for s, _ in sizes)))
+    src, main_file = _open_src(flags)
+    try:
+        asset_cache = _AssetCache(flags.asset_cache, flags.asset_cache_mb * 1024 * 1024) if flags.asset_cache else None
+        preamble_cache = _PreambleCache(flags.preamble_cache) if flags.preamble_cache else None
+        c = Copier(flags.encodings, main_file, flags.out_dir, src=src, asset_cache=asset_cache,
+                   preamble_cache=preamble_cache)
+        if flags.variants:
+            # list of tuples (original main file, main file out, name of the .tar and .pdf)
+            main_files = _copy_variants(c, flags)
+        else:
+            main_file_out = c.copy(flags.store_git_hash, flags.rename, flags.flatten, flags.extract_pdf_pages,
+                                   flags.parse_workers, flags.optimize_pdfs)
+            main_files = [(flags.main_file, main_file_out, os.path.splitext(os.path.basename(main_file_out))[0])]
+            _print_sizes(c.copied_file_sizes())
+    finally:
+        if src is not None:
+            src.close()
 
     if input('>>> Ready to compile? (We need to get that .bbl file!): [y/n] ') != 'y':
         sys.exit(0)
 
-    _compile_and_keep_bbl(main_file_out)
-    # TODO(release): must compile first and get .bbl
-    tar_file_name = os.path.splitext(os.path.basename(main_file_out))[0] + '.tar'
-    subprocess.call(f'tar -cvf ../{tar_file_name} *', shell=True, cwd=flags.out_dir)
-    tar_out_dir = os.path.abspath(os.path.join(flags.out_dir, '..'))
-    print(f'DONE! Upload {tar_file_name}, and maybe check the pdf (both stored in {tar_out_dir}).')
+    fmt_cache = _FormatCache(flags.fmt_cache, flags.fmt_engine) if flags.fmt_cache else None
+    for original_main_file, main_file_out, name in main_files:
+        _compile_and_keep_bbl(main_file_out, fmt_cache, flags.compile_timeout, name + '.pdf')
+        if flags.verify and src is not None:
+            print('*** --verify needs MAIN_FILE on disk, skipping.')
+        elif flags.verify and not _verify(original_main_file, main_file_out):
+            if input('>>> Packaged document differs from the original! Continue anyway? [y/n] ') != 'y':
+                sys.exit(1)
+        # TODO(release): must compile first and get .bbl
+        tar_file_name = name + '.tar'
+        main_out_dir = os.path.dirname(main_file_out)
+        tar_out_dir = os.path.abspath(os.path.join(main_out_dir, '..'))
+        if not _write_tar_with_manifest(LocalStorage(main_out_dir), os.path.join(tar_out_dir, tar_file_name)):
+            print(f'*** {tar_file_name} did not change since the last run, no need to upload it again.')
+        print(f'DONE! Upload {tar_file_name}, and maybe check the pdf (both stored in {tar_out_dir}).')
+
+
+def _write_tar_with_manifest(storage, tar_p):
+    """
+    Write all files of `storage` (except hidden ones at the top, like `tar *`) to a reproducible tar at `tar_p`, and
+    a SHA-256 manifest to `tar_p` + '.sha256'.
+    :return: False if the manifest is the same as the one already stored at that path, i.e., the tar did not change.
+    """
+    files = {p: storage.read(p) for p in storage.listdir() if not p.startswith('.')}
+    manifest = _sha256_manifest(files)
+    manifest_p = tar_p + '.sha256'
+    changed = True
+    if os.path.isfile(manifest_p):
+        with open(manifest_p, 'r') as f:
+            changed = f.read() != manifest
+    with open(tar_p, 'wb') as f:
+        write_tar(files, f)
+    with open(manifest_p, 'w') as f:
+        f.write(manifest)
+    print('Wrote {} ({} files) and {}'.format(tar_p, len(files), manifest_p))
+    return changed
+
+
+def _print_sizes(sizes):
+    print('Biggest files:')
+    print('\n'.join('{}kB: {}'.format(s, p) for s, p in sorted(sizes, reverse=True)[:10]))
+    print('Total: {}kB'.format(sum(s for s, _ in sizes)))
 
 
-def _compile_and_keep_bbl(main_file_out):
+def _copy_variants(c, flags):
+    """
+    Write every variant in the JSON file flags.variants to OUT_DIR/NAME, using a single parse of the project.
+    :return: list of tuples (original main file, main file out, variant name)
+    """
+    import json
+    with open(flags.variants, 'r') as f:
+        variants = [Variant(**v) for v in json.load(f)]
+    main_files = []
+    for variant in variants:
+        dst = LocalStorage(os.path.join(flags.out_dir, variant.name))
+        main_file_out, copied_files = c.copy_variant(variant, dst)
+        print(f'Variant {variant.name}:')
+        _print_sizes([(dst.getsize(p) // 1028, dst.path(p)) for p in copied_files])
+        original_main_file = os.path.join(os.path.dirname(flags.main_file), variant.main_file)
+        main_files.append((original_main_file, dst.path(main_file_out), variant.name))
+    return main_files
+
+
+def _open_src(flags):
+    """:return: tuple (src, main_file), where src is the Storage to read from and main_file is relative to src, or
+    None if MAIN_FILE should be read from disk."""
+    if flags.git_rev:
+        prefix, main_file = os.path.split(_normpath(flags.main_file))
+        return GitStorage(flags.git_repo, flags.git_rev, prefix), main_file
+    archive_p, main_file = _split_archive_path(flags.main_file)
+    if archive_p:
+        prefix, main_file = os.path.split(main_file)
+        return ArchiveStorage(archive_p, prefix), main_file
+    return None, flags.main_file
+
+
+def _compile_and_keep_bbl(main_file_out, fmt_cache=None, timeout=None, pdf_name=None):
+    """
+    Compile `main_file_out`, keep the .bbl, and move the .pdf next to the output directory, as `pdf_name` if given.
+    """
     print('*** Compiling', main_file_out)
     out_dir = os.path.dirname(main_file_out)
     files_before_compile = set(os.listdir(out_dir))
     assert not any(p.endswith('.bbl') for p in files_before_compile)
-    _compile(main_file_out)
-    files_after_compile = set(os.listdir(out_dir))
-    print(f'*** Searching for .bll file in {files_after_compile}...')
-    try:
-        bbl_file = next(p for p in files_after_compile if p.endswith('.bbl'))
-    except StopIteration:
+    result = _compile(main_file_out, fmt_cache, timeout)
+    if result.error:
+        print('*** Error! Compile failed:')
+        print(result.error)
+        sys.exit(1)
+    bbl_file, pdf_out = result.bbl, result.pdf
+    if bbl_file is None:
         print('*** Error! .bbl file not found. Did you compile?')
         sys.exit(1)
-    pdf_out = next(p for p in files_after_compile if p.endswith('.pdf'))
-    os.rename(os.path.join(out_dir, pdf_out), os.path.abspath(os.path.join(out_dir, '..', pdf_out)))
-    print('Keeping', pdf_out, '-- please check!')
+    if pdf_out is None:
+        print('*** Error! .pdf file not found. Did you compile?')
+        sys.exit(1)
+    files_after_compile = set(os.listdir(out_dir))
+    pdf_kept = os.path.abspath(os.path.join(out_dir, '..', pdf_name or os.path.basename(pdf_out)))
+    os.rename(os.path.join(out_dir, pdf_out), pdf_kept)
+    print('Keeping', pdf_kept, '-- please check!')
     unneeded_files = (files_after_compile - files_before_compile) - {bbl_file, pdf_out}
     print('Unneeded', unneeded_files)
     for unneeded_file in unneeded_files:
@@ -130,18 +272,627 @@ def _compile_and_keep_bbl(main_file_out):
         os.remove(p)
 
 
-def _compile(main_file_out):
+# Result of `_compile`. pdf and bbl are relative to the directory of the main file, or None if they were not
+# produced. error is None, or a message with an excerpt of the log if the compile failed.
+CompileResult = namedtuple('CompileResult', ['pdf', 'bbl', 'error'])
+
+# Errors after which further passes cannot succeed, see _run_compile.
+_RE_FATAL_ERROR = re.compile(r"^!\s*(LaTeX Error: File `.*?' not found|I can't find file|Emergency stop"
+                             r"|==> Fatal error occurred|TeX capacity exceeded)")
+# Lines of the .log shown around a fatal error.
+_LOG_EXCERPT_LINES_BEFORE = 3
+_LOG_EXCERPT_LINES_AFTER = 8
+
+
+def _compile(main_file_out, fmt_cache=None, timeout=None):
+    """
+    :param fmt_cache: If given, a _FormatCache. The preamble of `main_file_out` is loaded from a precompiled format
+        if possible, otherwise, we fall back to a normal compile.
+    :param timeout: If given, stop compiling after that many seconds.
+    :return: CompileResult
+    """
     cwd, filename = os.path.split(main_file_out)
     assert filename.endswith('.tex'), filename
-    cmd = ['latexmk', filename, '--view=pdf']
+    name = os.path.splitext(filename)[0]
+    cmd = ['latexmk', filename, '--view=pdf', '-interaction=nonstopmode', '-recorder']
+    env = None
+    fmt_name = fmt_cache.get_format(main_file_out) if fmt_cache else None
+    if fmt_name:
+        cmd.append(f'-pdflatex={fmt_cache.engine} -fmt={fmt_name} %O %S')
+        env = fmt_cache.env()
     try:
-        subprocess.call(cmd, cwd=cwd, stdout=subprocess.DEVNULL)
+        error = _run_compile(cmd, cwd, os.path.join(cwd, name + '.log'), env, timeout)
     except FileNotFoundError:
         cmd = ' '.join(cmd)
         print('*** Error when running `{}` in {}'.format(cmd, cwd))
         print('*** Please run a compile step in another shell and return here.')
         if input('>>> Did you compile: [y/n] ') != 'y':
             sys.exit(0)
+        error = None
+    pdf, bbl = _recorded_outputs(cwd, name)
+    return CompileResult(pdf, bbl, error)
+
+
+def _run_compile(cmd, cwd, log_p, env=None, timeout=None):
+    """Run `cmd` in `cwd`, and follow its output and the .log at `log_p` while it runs.
+
+    On a fatal error (see _RE_FATAL_ERROR) or after `timeout` seconds, the process and all its children (e.g., the
+    engine started by latexmk) are killed.
+    :return: None if `cmd` finished, else an error message including an excerpt of the log.
+    :raise FileNotFoundError: if the program of `cmd` does not exist.
+    """
+    import queue
+    # A new session, such that the whole process tree can be killed, see _kill_process_tree.
+    proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, start_new_session=True)
+    output = queue.Queue()
+
+    def read_output():
+        for line in proc.stdout:
+            output.put(line.decode('utf-8', errors='replace'))
+        output.put(None)
+
+    threading.Thread(target=read_output, daemon=True).start()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    log_tail = _FileTail(log_p)
+    error = None
+    while error is None:
+        try:
+            line = output.get(timeout=0.1)
+        except queue.Empty:
+            line = ''
+        if line is None:
+            break
+        if line.startswith('Latexmk:'):
+            print('***', line.rstrip())
+        fatal_line = next((l for l in [line] + log_tail.read_lines() if _RE_FATAL_ERROR.search(l)), None)
+        if fatal_line:
+            error = 'Fatal error: {}\n{}'.format(fatal_line.strip(), _log_excerpt(log_p, fatal_line))
+        elif deadline is not None and time.monotonic() > deadline:
+            error = 'Timeout after {}s.\n{}'.format(timeout, _log_excerpt(log_p))
+    if error is not None:
+        print('*** Stopping `{}`'.format(' '.join(cmd)))
+        _kill_process_tree(proc)
+    proc.wait()
+    proc.stdout.close()
+    return error
+
+
+class _FileTail(object):
+    """Reads the lines that were appended to a file since the last call. TeX rewrites the .log on every pass, which
+    is detected by the file getting shorter."""
+    def __init__(self, p):
+        self.p = p
+        self._offset = 0
+        self._partial = b''
+
+    def read_lines(self):
+        try:
+            with open(self.p, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < self._offset:
+                    self._offset, self._partial = 0, b''
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        self._offset += len(data)
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        return [l.decode('utf-8', errors='replace') for l in lines]
+
+
+def _log_excerpt(log_p, line=None):
+    """:return: the lines of the log at `log_p` around `line`, or the last lines if `line` is not found."""
+    try:
+        with open(log_p, 'r', encoding='utf-8', errors='replace') as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return ''
+    i = next((i for i, l in enumerate(lines) if line and l.strip() == line.strip()), len(lines))
+    return '\n'.join(lines[max(i - _LOG_EXCERPT_LINES_BEFORE, 0):i + _LOG_EXCERPT_LINES_AFTER])
+
+
+def _kill_process_tree(proc):
+    if sys.platform == 'win32':
+        subprocess.call(['taskkill', '/F', '/T', '/PID', str(proc.pid)], stdout=subprocess.DEVNULL)
+        return
+    import signal
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:  # Already done.
+        pass
+
+
+def _recorded_outputs(cwd, name):
+    """:return: tuple (pdf, bbl) of the compile of `name`.tex in `cwd`, relative to `cwd`, or None if not found.
+
+    Uses the recorder data (`name`.fls), where the engine lists all files it read and wrote. The .bbl is written by
+    bibtex, but read by the engine. Without recorder data, the default file names are checked.
+    """
+    pdf = bbl = None
+    fls_p = os.path.join(cwd, name + '.fls')
+    if os.path.isfile(fls_p):
+        with open(fls_p, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                kind, _, p = line.rstrip('\n').partition(' ')
+                p = os.path.relpath(os.path.join(cwd, p), cwd)  # Recorded paths might be absolute.
+                if kind == 'OUTPUT' and p.endswith('.pdf'):
+                    pdf = p
+                elif kind == 'INPUT' and p.endswith('.bbl') and not p.startswith('..'):
+                    bbl = p
+    if pdf is None and os.path.isfile(os.path.join(cwd, name + '.pdf')):
+        pdf = name + '.pdf'
+    if bbl is None and os.path.isfile(os.path.join(cwd, name + '.bbl')):
+        bbl = name + '.bbl'
+    return pdf, bbl
+
+
+def test_run_compile():
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        # Stub latexmk: reports a missing file in the output and the .log, and would then hang.
+        cmd = os.path.join(d, 'stubmk')
+        with open(cmd, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'printf "(./main.tex\\nl.3 \\\\usepackage{missing}\\n" > main.log\n'
+                    'echo "! LaTeX Error: File \\`missing.sty\' not found."\n'
+                    'sleep 30\n')
+        os.chmod(cmd, 0o755)
+        start = time.perf_counter()
+        error = _run_compile([cmd], d, os.path.join(d, 'main.log'))
+        assert "File `missing.sty' not found" in error and 'l.3' in error, error
+        error = _run_compile(['sleep', '30'], d, os.path.join(d, 'missing.log'), timeout=0.5)
+        assert error.startswith('Timeout'), error
+        assert time.perf_counter() - start < 10
+        assert _run_compile(['true'], d, os.path.join(d, 'main.log')) is None
+
+        with open(os.path.join(d, 'main.fls'), 'w') as f:
+            f.write('PWD {}\nINPUT /usr/share/texmf/tex/latex/base/article.cls\nINPUT ./main.bbl\n'
+                    'OUTPUT main.log\nOUTPUT {}\n'.format(d, os.path.join(d, 'main.pdf')))
+        assert _recorded_outputs(d, 'main') == ('main.pdf', 'main.bbl')
+        assert _recorded_outputs(d, 'other') == (None, None)
+
+
+# Summary of a compile, used to check that the packaged document matches the original.
+# page_hashes is a list of hashes of the text of every page, or None if pdftotext is not available.
+CompileSummary = namedtuple('CompileSummary', ['num_pages', 'page_hashes', 'num_warnings', 'num_undefined'])
+
+_RE_LOG_OUTPUT_WRITTEN = re.compile(r'Output written on .*?\((\d+) pages?')
+_RE_LOG_WARNING = re.compile(r'Warning', re.IGNORECASE)
+_RE_LOG_UNDEFINED = re.compile(r'(Reference|Citation) .* undefined')
+
+
+def _verify(main_file, main_file_out):
+    """Compile the original tree of `main_file` and the output tree of `main_file_out` in parallel, each in its own
+    scratch directory, and compare the results.
+
+    :return: True if no difference was found.
+    """
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    print('*** Verifying', main_file_out, 'against', main_file)
+    with tempfile.TemporaryDirectory() as scratch_dir, ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(_compile_in_scratch_dir, p, os.path.join(scratch_dir, name))
+                   for name, p in (('original', main_file), ('packaged', main_file_out))]
+        original, packaged = (f.result() for f in futures)
+    differences = _compare_compile_summaries(original, packaged)
+    for difference in differences:
+        print('*** Verify:', difference)
+    if not differences:
+        print('*** Verify: packaged document matches the original ({} pages).'.format(packaged.num_pages))
+    return not differences
+
+
+def _compile_in_scratch_dir(main_p, scratch_dir):
+    """Copy the directory of `main_p` to `scratch_dir`, compile there, and return a CompileSummary."""
+    src_dir, filename = os.path.split(os.path.abspath(main_p))
+    shutil.copytree(src_dir, scratch_dir, ignore=shutil.ignore_patterns('.git'))
+    cmd = ['latexmk', filename, '-pdf', '-interaction=nonstopmode']
+    name = os.path.splitext(filename)[0]
+    try:
+        error = _run_compile(cmd, scratch_dir, os.path.join(scratch_dir, name + '.log'))
+        if error:
+            print('*** Error when compiling {}: {}'.format(main_p, error))
+    except FileNotFoundError:
+        print('*** Error when running `{}`, cannot verify.'.format(' '.join(cmd)))
+    return _summarize_compile(os.path.join(scratch_dir, name + '.log'), os.path.join(scratch_dir, name + '.pdf'))
+
+
+def _summarize_compile(log_p, pdf_p):
+    num_pages, num_warnings, num_undefined = None, 0, 0
+    if os.path.isfile(log_p):
+        with open(log_p, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                m = _RE_LOG_OUTPUT_WRITTEN.search(line)
+                if m:
+                    num_pages = int(m.group(1))
+                num_warnings += bool(_RE_LOG_WARNING.search(line))
+                num_undefined += bool(_RE_LOG_UNDEFINED.search(line))
+    return CompileSummary(num_pages, _page_hashes(pdf_p), num_warnings, num_undefined)
+
+
+def _page_hashes(pdf_p):
+    if not os.path.isfile(pdf_p):
+        return None
+    try:
+        text = subprocess.check_output(['pdftotext', '-q', pdf_p, '-'], stderr=subprocess.DEVNULL)
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        return None
+    # pdftotext separates pages with form feeds. Ignore whitespace, which depends on the layout only.
+    pages = text.decode('utf-8', errors='replace').split('\f')
+    if pages and not pages[-1].strip():
+        pages.pop()
+    return [hashlib.sha256(''.join(page.split()).encode()).hexdigest() for page in pages]
+
+
+def _compare_compile_summaries(original, packaged):
+    """:return: list of human readable differences between two CompileSummary."""
+    if original.num_pages is None or packaged.num_pages is None:
+        return ['Could not compile {}'.format(
+                ' and '.join(name for name, summary in (('original', original), ('packaged', packaged))
+                             if summary.num_pages is None))]
+    differences = []
+    for field in ('num_pages', 'num_warnings', 'num_undefined'):
+        o, p = getattr(original, field), getattr(packaged, field)
+        if o != p:
+            differences.append('{}: original={}, packaged={}'.format(field, o, p))
+    if original.page_hashes is None or packaged.page_hashes is None:
+        print('*** Verify: pdftotext not found, not comparing text of pages.')
+    else:
+        differences += ['Text differs on page {}'.format(i + 1)
+                        for i, (o, p) in enumerate(zip(original.page_hashes, packaged.page_hashes)) if o != p]
+    return differences
+
+
+def test_compare_compile_summaries():
+    original = CompileSummary(2, ['a', 'b'], 3, 0)
+    assert _compare_compile_summaries(original, original) == []
+    assert _compare_compile_summaries(original, CompileSummary(2, ['a', 'c'], 4, 0)) == [
+        'num_warnings: original=3, packaged=4', 'Text differs on page 2']
+    assert _compare_compile_summaries(original, CompileSummary(None, None, 0, 0)) == ['Could not compile packaged']
+
+
+class _FormatCache(object):
+    """Cache of precompiled preambles ("formats"), created with `mylatexformat`.
+
+    Formats are stored in `cache_dir`, keyed by the hash of the preamble of the main file (everything before
+    \\begin{document}), all local .sty and .cls files, and the engine and its version. Next to every format, the
+    SHA-256 of all files read while dumping it are stored (from the recorder data, `-recorder`), e.g. packages
+    loaded by local packages or updated system packages, and the format is dumped again if any of them changed.
+    Compiling with a format skips loading the packages of the preamble, which is where most of the compile time goes
+    for tikz/pgfplots heavy papers.
+    """
+    def __init__(self, cache_dir, engine='pdflatex'):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.engine = engine
+        self._engine_version = None  # See _preamble_hash.
+
+    def get_format(self, main_file_out):
+        """
+        :return: name of a format for `main_file_out` in `cache_dir`, dumping it if needed, or None if the format
+        cannot be created (e.g., the engine does not support -ini or mylatexformat is not installed).
+        """
+        cwd, filename = os.path.split(main_file_out)
+        fmt_name = 'arxiv_prep_' + self._preamble_hash(main_file_out)
+        fmt_p = os.path.join(self.cache_dir, fmt_name + '.fmt')
+        inputs_p = os.path.join(self.cache_dir, fmt_name + '.inputs.json')
+        if os.path.isfile(fmt_p) and self._inputs_unchanged(inputs_p, cwd):
+            print('*** Using cached format', fmt_p)
+            return fmt_name
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cmd = [self.engine, '-ini', '-interaction=nonstopmode', '-recorder', f'-jobname={fmt_name}',
+               f'-output-directory={self.cache_dir}', '&' + self.engine, 'mylatexformat.ltx', filename]
+        print('*** Dumping format', fmt_p)
+        try:
+            ret = subprocess.call(cmd, cwd=cwd, stdout=subprocess.DEVNULL)
+        except FileNotFoundError:
+            ret = None
+        if ret != 0 or not os.path.isfile(fmt_p):
+            print('*** Could not create format with `{}` (exit code {}), compiling without format.'.format(
+                    ' '.join(cmd), ret))
+            return None
+        self._save_inputs(os.path.join(self.cache_dir, fmt_name + '.fls'), inputs_p, main_file_out)
+        return fmt_name
+
+    def env(self):
+        """:return: environment where the engine finds formats in `cache_dir`. The trailing separator makes kpathsea
+        append the default search path."""
+        env = dict(os.environ)
+        env['TEXFORMATS'] = self.cache_dir + os.pathsep + env.get('TEXFORMATS', '')
+        return env
+
+    def _save_inputs(self, fls_p, inputs_p, main_file_out):
+        """Store the SHA-256 of all files read according to the recorder data `fls_p` in `inputs_p`, except for the
+        main file, whose preamble is part of the key. Files in the directory of the main file are stored relative to
+        it. Without recorder data, nothing is stored, and the format is only keyed by _preamble_hash."""
+        import json
+        main_file_out = os.path.abspath(main_file_out)
+        main_dir = cwd = os.path.dirname(main_file_out)
+        inputs, outputs = [], set()
+        try:
+            with open(fls_p, 'r', encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    kind, _, p = line.rstrip('\n').partition(' ')
+                    if kind == 'PWD':
+                        cwd = p
+                    elif kind in ('INPUT', 'OUTPUT'):
+                        p = os.path.normpath(os.path.join(cwd, p))
+                        (inputs.append if kind == 'INPUT' else outputs.add)(p)
+        except FileNotFoundError:
+            return
+        hashes = {}
+        for p in inputs:
+            if p in outputs or p == main_file_out or not os.path.isfile(p):
+                continue
+            rel_p = os.path.relpath(p, main_dir)
+            with open(p, 'rb') as f:
+                hashes[p if rel_p.startswith('..') else rel_p] = hashlib.sha256(f.read()).hexdigest()
+        with open(inputs_p, 'w') as f:
+            json.dump(hashes, f)
+
+    @staticmethod
+    def _inputs_unchanged(inputs_p, cwd):
+        """:return: True if none of the files stored by _save_inputs in `inputs_p` changed, where relative paths are
+        relative to `cwd`. Without recorder data of the format, nothing is checked."""
+        import json
+        try:
+            with open(inputs_p, 'r') as f:
+                hashes = json.load(f)
+        except FileNotFoundError:
+            return True
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return False
+        for p, sha256 in hashes.items():
+            p = os.path.join(cwd, p)
+            if not os.path.isfile(p):
+                print(f'*** {p} was removed, dumping format again.')
+                return False
+            with open(p, 'rb') as f:
+                if hashlib.sha256(f.read()).hexdigest() != sha256:
+                    print(f'*** {p} changed, dumping format again.')
+                    return False
+        return True
+
+    def _preamble_hash(self, main_file_out):
+        if self._engine_version is None:
+            try:
+                self._engine_version = subprocess.run([self.engine, '--version'], stdout=subprocess.PIPE,
+                                                      stderr=subprocess.DEVNULL).stdout.split(b'\n')[0]
+            except OSError:
+                self._engine_version = b''
+        h = hashlib.sha256(self.engine.encode())
+        h.update(self._engine_version)
+        with open(main_file_out, 'rb') as f:
+            for line in f:
+                if _BEGIN_DOCUMENT_MARKER.encode() in line:
+                    break
+                h.update(line)
+        # Local packages and classes are part of the format, too.
+        cwd = os.path.dirname(main_file_out)
+        for p in sorted(glob.glob(os.path.join(cwd, '*.sty')) + glob.glob(os.path.join(cwd, '*.cls'))):
+            with open(p, 'rb') as f:
+                h.update(os.path.basename(p).encode())
+                h.update(f.read())
+        return h.hexdigest()[:16]
+
+
+def test_format_cache():
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        # Stub engine: writes JOBNAME.fmt to the output directory, like `pdflatex -ini` would.
+        engine = os.path.join(d, 'stubtex')
+        with open(engine, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    f'[ "$1" = --version ] && echo "StubTeX $(cat {d}/version)" && exit\n'
+                    'for a in "$@"; do case $a in -jobname=*) j=${a#*=};; -output-directory=*) o=${a#*=};; esac; done\n'
+                    'echo stub > "$o/$j.fmt"\n'
+                    'printf "PWD $PWD\\nINPUT main.tex\\nINPUT sub/dep.sty\\nOUTPUT $o/$j.fmt\\n" > "$o/$j.fls"\n')
+        os.chmod(engine, 0o755)
+        main_file_out = os.path.join(d, 'main.tex')
+        os.makedirs(os.path.join(d, 'sub'))
+        for p, content in (('main.tex', '\\documentclass{article}\n\\begin{document}\nText\n\\end{document}\n'),
+                           ('sub/dep.sty', 'dep'), ('version', '1.0')):
+            with open(os.path.join(d, p), 'w') as f:
+                f.write(content)
+        fmt_cache = _FormatCache(os.path.join(d, 'cache'), engine)
+        fmt_name = fmt_cache.get_format(main_file_out)
+        fls_p = os.path.join(d, 'cache', fmt_name + '.fls')  # Removed to see whether the format is dumped again.
+        assert os.path.isfile(os.path.join(d, 'cache', fmt_name + '.fmt'))
+        os.remove(fls_p)
+        with open(main_file_out, 'a') as f:
+            f.write('Changing the body does not invalidate the format.\n')
+        assert fmt_cache.get_format(main_file_out) == fmt_name and not os.path.isfile(fls_p)
+        # Files read while dumping the format invalidate it, even if they are not local packages.
+        with open(os.path.join(d, 'sub', 'dep.sty'), 'w') as f:
+            f.write('changed')
+        assert fmt_cache.get_format(main_file_out) == fmt_name and os.path.isfile(fls_p)
+        # So does a different version of the engine.
+        with open(os.path.join(d, 'version'), 'w') as f:
+            f.write('2.0')
+        assert _FormatCache(os.path.join(d, 'cache'), engine).get_format(main_file_out) != fmt_name
+        assert _FormatCache(os.path.join(d, 'cache'), os.path.join(d, 'missing')).get_format(main_file_out) is None
+
+
+class _AssetCache(object):
+    """Content-addressed cache of converted static files (e.g., images converted to .jpg, PDFs reduced to some
+    pages), shared between all papers and runs.
+
+    Entries are keyed by the SHA-256 of the input bytes and the parameters of the conversion, and stored as files in
+    `cache_dir`, which can be linked into OUT_DIR, see _link_or_copy. Using an entry updates its modification time.
+    Whenever the cache grows beyond `max_bytes`, the least recently used entries are removed.
+    """
+    def __init__(self, cache_dir, max_bytes=_ASSET_CACHE_MAX_MB * 1024 * 1024):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(data, params):
+        """:param params: tuple describing the conversion of `data`, e.g., ('jpg', 95)."""
+        h = hashlib.sha256(repr(params).encode())
+        h.update(b'\0')
+        h.update(data)
+        return h.hexdigest()
+
+    def get(self, key):
+        """:return: path of the entry for `key`, or None if there is none."""
+        p = self._path(key)
+        try:
+            os.utime(p)  # Mark as recently used.
+        except FileNotFoundError:
+            return None
+        return p
+
+    def put(self, key, data):
+        """Store `data` for `key`, and evict old entries if needed.
+        :return: path of the entry, which might be evicted right away if `data` alone exceeds `max_bytes`."""
+        import tempfile
+        p = self._path(key)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        # Write to a temporary file first, such that concurrent runs never see partial entries.
+        fd, tmp_p = tempfile.mkstemp(dir=os.path.dirname(p), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_p, p)
+        self._evict()
+        return p
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _evict(self):
+        entries = []  # (mtime, size, path)
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for f in filenames:
+                if f.endswith('.tmp'):
+                    continue
+                p = os.path.join(dirpath, f)
+                try:
+                    st = os.stat(p)
+                except FileNotFoundError:  # Evicted by a concurrent run.
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, p))
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            print('*** Evicting', p, 'from asset cache')
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def _link_or_copy(src_p, dst_p):
+    """Create `dst_p` with the contents of `src_p` as cheaply as possible: as reflink (copy-on-write clone) if the
+    file system supports it, else as hardlink, else as copy. Since `dst_p` might share its inode with `src_p`, it must
+    be replaced, not modified in place, see LocalStorage.write."""
+    os.makedirs(os.path.dirname(dst_p), exist_ok=True)
+    if os.path.lexists(dst_p):
+        os.remove(dst_p)
+    try:
+        import fcntl
+        with open(src_p, 'rb') as fin, open(dst_p, 'wb') as fout:
+            fcntl.ioctl(fout.fileno(), _FICLONE, fin.fileno())
+        return
+    except (ImportError, OSError):
+        if os.path.lexists(dst_p):
+            os.remove(dst_p)
+        if not os.path.isfile(src_p):
+            raise FileNotFoundError(src_p)
+    try:
+        os.link(src_p, dst_p)
+    except OSError:
+        shutil.copyfile(src_p, dst_p)
+
+
+def test_asset_cache():
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        cache = _AssetCache(os.path.join(d, 'cache'), max_bytes=8)
+        key = cache.key(b'png', ('jpg', 95))
+        assert key != cache.key(b'png', ('jpg', 90)) and cache.get(key) is None
+        p = cache.put(key, b'jpg95')
+        assert cache.get(key) == p
+        _link_or_copy(p, os.path.join(d, 'out', 'a.jpg'))
+        with open(os.path.join(d, 'out', 'a.jpg'), 'rb') as f:
+            assert f.read() == b'jpg95'
+        os.utime(p, ns=(0, 0))  # Least recently used.
+        other_key = cache.key(b'other', ('jpg', 95))
+        cache.put(other_key, b'jpg95')
+        assert cache.get(key) is None and cache.get(other_key) is not None
+        # The linked output is not affected by the eviction, nor is the cache affected by overwriting the output.
+        LocalStorage(os.path.join(d, 'out')).write('a.jpg', b'new')
+        with open(cache.get(other_key), 'rb') as f:
+            assert f.read() == b'jpg95'
+
+
+class _PreambleCache(object):
+    """Snapshots of the definitions made in the preamble of a main file, see Copier._parse_main_file.
+
+    Snapshots are stored as JSON in `cache_dir`, keyed by the (comment stripped) preamble of the main file. Every
+    snapshot contains the SHA-256 of all other files that were parsed for the preamble (e.g., a shared macros.tex),
+    and the results of all file lookups made for its includes (e.g., a missing optional mystyle.sty, or the file
+    found for \\includegraphics{logo}). It is only used if none of them changed.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+
+    def load(self, key, src):
+        """:return: the snapshot for `key`, or None if there is none or if it is outdated."""
+        import json
+        try:
+            with open(self._path(key), 'r') as f:
+                snapshot = json.load(f)
+            files, lookups = snapshot['files'], snapshot['lookups']
+            isfile_lookups, glob_lookups = lookups['isfile'], lookups['glob']
+        except FileNotFoundError:
+            return None
+        except (json.JSONDecodeError, KeyError, TypeError) as e:
+            print('*** Invalid preamble snapshot {} ({!r}), not using it.'.format(self._path(key), e))
+            return None
+        for rel_p, sha256 in files.items():
+            if not src.isfile(rel_p) or hashlib.sha256(src.read(rel_p)).hexdigest() != sha256:
+                print(f'*** {rel_p} changed, not using preamble snapshot.')
+                return None
+        for rel_p, exists in isfile_lookups.items():
+            if src.isfile(rel_p) != exists:
+                print('*** {} {}, not using preamble snapshot.'.format(rel_p, 'was removed' if exists else 'was added'))
+                return None
+        for rel_pattern, matches in glob_lookups.items():
+            if sorted(src.glob(rel_pattern)) != matches:
+                print(f'*** Files matching {rel_pattern} changed, not using preamble snapshot.')
+                return None
+        print('*** Using preamble snapshot', self._path(key))
+        return snapshot
+
+    def save(self, key, snapshot):
+        import json
+        import tempfile
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_p = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_p, self._path(key))
+        print('*** Saved preamble snapshot', self._path(key))
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+
+def _dependency_to_json(dep):
+    kind = 'tex' if isinstance(dep.file, TexFile) else 'static'
+    return [kind, list(dep.file), list(dep.envs)]
+
+
+def _dependency_from_json(dep):
+    kind, fields, envs = dep
+    return Dependency(TexFile(*fields) if kind == 'tex' else StaticFile(*fields), tuple(envs))
+
+
+def assert_exc(cond, msg=None, exc=ValueError):
+    if not cond:
+        raise exc(msg)
 
 
 def _replace_all(s, rep):
@@ -198,94 +949,491 @@ def _consume_until_closing_bracket(first_line, f_iter):
     raise ValueError('Could not find needed closing brackets!')
 
 
-class Copier(object):
-    def __init__(self, encodings, tex_root_file, out_dir):
-        self.encodings = encodings
-        self.tex_root_dir = os.path.dirname(os.path.abspath(tex_root_file))
-        # Relative to tex_root_dir.
-        self.tex_root_p = os.path.basename(tex_root_file)
-        assert os.path.isfile(os.path.join(self.tex_root_dir, self.tex_root_p))
+def _update_envs(envs, line):
+    """
+    Update the list `envs` of open environments with every \\begin and \\end in `line`.
+    :return: tuple of all environments that are open somewhere in `line`.
+    """
+    line_envs = list(envs)
+    for m in _RE_ENVIRONMENT.finditer(line):
+        if m.group(1) == 'begin':
+            envs.append(m.group(2))
+            line_envs.append(m.group(2))
+        elif envs and envs[-1] == m.group(2):
+            envs.pop()
+    return tuple(line_envs)
+
+
+def _strip_environments(text, envs):
+    """Remove all environments named in `envs`, i.e., everything from \\begin{env} to \\end{env}."""
+    for env in envs:
+        env = re.escape(env)
+        text = re.sub(r'\\begin{' + env + r'}.*?\\end{' + env + '}[ \t]*\n?', '', text, flags=re.DOTALL)
+    return text
+
+
+def test_envs():
+    envs = []
+    assert _update_envs(envs, '\\begin{document}\n') == ('document',)
+    assert _update_envs(envs, '\\begin{figure}\\includegraphics{a}\\end{figure}\n') == ('document', 'figure')
+    assert envs == ['document']
+    assert _strip_environments('A\n\\begin{supp}\nB\n\\end{supp}\nC\n', ['supp']) == 'A\nC\n'
+
+
+class _RecordingIter(object):
+    """Wraps the enumerate(f) iterator used in `Copier._parse_file` and records all lines that are handed out, such
+    that lines consumed by `_consume_until_closing_bracket` can be written out again with --flatten."""
+    def __init__(self, f_iter):
+        self._f_iter = f_iter
+        self._recorded = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        i, line = next(self._f_iter)
+        self._recorded.append(line)
+        return i, line
+
+    def pop_recorded(self):
+        recorded, self._recorded = self._recorded, []
+        return recorded
+
+
+class _FlatWriter(object):
+    """Output of --flatten. Strips comments like `strip_comments`, and ignores everything after \\end{document}."""
+    def __init__(self, fout):
+        self._fout = fout
+        # Dictionary {relative_p -> (text, encoding)} of all files written, see Copier._flatten.
+        self.texts = {}
+        self._l_prev = None
+        self._ends_with_newline = True
+        self.done = False
+
+    def write(self, l):
+        if self.done:
+            return
+        l = strip_comments_from_line(l, self._l_prev)
+        if not l:
+            return
+        self._l_prev = l
+        self._write(l)
+        if _END_DOCUMENT_MARKER in l:
+            print('Reached {}, stopping...'.format(l.strip()))
+            self._write('\n')
+            self.done = True
+
+    def write_piece(self, l):
+        """Write part of a line around an inlined include. Whitespace-only pieces are dropped, as they would
+        otherwise introduce empty lines, i.e., new paragraphs."""
+        if l.strip():
+            self.write(l)
+
+    def end_line(self):
+        if not self._ends_with_newline:
+            self._write('\n')
+
+    def _write(self, l):
+        if self.done:
+            return
+        self._fout.write(l)
+        self._ends_with_newline = l.endswith('\n')
 
-        self.out_dir = os.path.abspath(out_dir)
 
-        self._convert_jpg_exts = []  # [] if not set!
-        self._copied_file_ps = set()
-
-        # _regexes: dictionary {\command -> compiled regexes matching command invocations}
-        # _command_definitions: dictionary {\command -> (definition, num_args)
-        # Example:
-        #   regexes = {r"\imgs":      r'(\\imgs){(.*?)}{(.*?)}',
-        #              r"\imagesdir": r'(\\imagesdir){(.*?)}',
-        #              r"\noargs":    r'(\\noargs)(\W|$)' }
-        #   definitions = {r"\imgs":      (r"\include[123]{\imagesdir{2}/#1/#2.jpg}", 2),
-        #                  r"\imagesdir": ("imgs_#1", 1),
-        #                  r"\noargs":    ("Using \imgs{hello}{world}", 0)}
-        self._regexes = {}
-        self._command_definitions = {}
-
-    def copy(self, store_git_hash=False, rename=None):
-        """Copy main file recursively."""
-        self._copy(self.tex_root_p)  # TODO: maybe copy and strip
-        self._parse_file(self.tex_root_p)
-        main_file_out = os.path.join(self.out_dir, self.tex_root_p)
-        if store_git_hash:
-            self._store_git_hash(main_file_out)
-        if rename:
-            _, ext = os.path.splitext(rename)
-            if not ext:
-                rename += '.tex'
-            main_file_out_new = os.path.join(self.out_dir, rename)
-            os.rename(main_file_out, main_file_out_new)
-            self._copied_file_ps.remove(main_file_out)
-            self._copied_file_ps.add(main_file_out_new)
-            main_file_out = main_file_out_new
-        return main_file_out
+# Storage ----------------------------------------------------------------------
 
-    def _store_git_hash(self, main_file_out):
-        git_hash = self._get_git_hash()
-        if git_hash:
-            print('Writing git hash {}...'.format(git_hash))
-            _insert_in_file(main_file_out, text='% ' + git_hash)
 
-    def _get_git_hash(self):
-        repo = self.tex_root_dir
+class Storage(object):
+    """Files of a LaTeX project or of the output, addressed by paths relative to the root of the storage.
+
+    Copier only accesses files through this interface, see LocalStorage and MemoryStorage.
+    """
+    # Directory on disk, or None if the files are not on disk.
+    root = None
+
+    def read(self, rel_p):
+        """:return: contents of `rel_p` as bytes."""
+        raise NotImplementedError()
+
+    def isfile(self, rel_p):
+        raise NotImplementedError()
+
+    def getsize(self, rel_p):
+        return len(self.read(rel_p))
+
+    def glob(self, rel_pattern):
+        """:return: list of paths matching `rel_pattern`, where * does not match /."""
+        raise NotImplementedError()
+
+    def listdir(self):
+        """:return: list of all files, relative to the root, sorted."""
+        raise NotImplementedError()
+
+    def write(self, rel_p, data):
+        """Write bytes `data` to `rel_p`, creating directories as needed."""
+        raise NotImplementedError()
+
+    def rename(self, rel_p, new_rel_p):
+        raise NotImplementedError()
+
+    def path(self, rel_p):
+        """:return: path of `rel_p` for messages, and for LocalStorage, the path on disk."""
+        return _normpath(rel_p)
+
+    def cache_key(self, rel_p):
+        """:return: a hashable key that changes whenever the contents of `rel_p` change, or None if unknown."""
+        return None
+
+    def close(self):
+        pass
+
+
+class LocalStorage(Storage):
+    def __init__(self, root):
+        self.root = root
+
+    def read(self, rel_p):
+        with open(self.path(rel_p), 'rb') as f:
+            return f.read()
+
+    def isfile(self, rel_p):
+        return os.path.isfile(self.path(rel_p))
+
+    def getsize(self, rel_p):
+        return os.path.getsize(self.path(rel_p))
+
+    def glob(self, rel_pattern):
+        return [os.path.relpath(p, self.root) for p in glob.glob(self.path(rel_pattern))]
+
+    def listdir(self):
+        return sorted(os.path.relpath(os.path.join(dirpath, f), self.root)
+                      for dirpath, _, filenames in os.walk(self.root) for f in filenames)
+
+    def write(self, rel_p, data):
+        p = self.path(rel_p)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        if os.path.lexists(p):  # Might be linked to the asset cache, see _link_or_copy.
+            os.remove(p)
+        with open(p, 'wb') as f:
+            f.write(data)
+
+    def rename(self, rel_p, new_rel_p):
+        os.rename(self.path(rel_p), self.path(new_rel_p))
+
+    def path(self, rel_p):
+        return os.path.join(self.root, rel_p)
+
+    def cache_key(self, rel_p):
+        p = os.path.abspath(self.path(rel_p))
+        st = os.stat(p)
+        return p, st.st_mtime_ns, st.st_size
+
+
+class MemoryStorage(Storage):
+    def __init__(self, files=None):
+        """:param files: optional dictionary {rel_p -> bytes}."""
+        self.files = {}
+        for rel_p, data in (files or {}).items():
+            self.write(rel_p, data)
+
+    def read(self, rel_p):
         try:
-            git_commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo).decode()
-            return git_commit.strip()
-        except subprocess.CalledProcessError:
-            return None
+            return self.files[_normpath(rel_p)]
+        except KeyError:
+            raise FileNotFoundError(rel_p)
 
-    def copied_file_sizes(self):
-        return [(os.path.getsize(p) // 1028, p) for p in self._copied_file_ps]
+    def isfile(self, rel_p):
+        return _normpath(rel_p) in self.files
 
-    def _parse_file(self, relative_p):
-        # if '.sty' in relative_p:
-        #     print('Skipping', relative_p)
-        #     return
-        p = os.path.join(self.tex_root_dir, relative_p)
-        is_sty_file = relative_p.endswith('.sty')
-        print(f'Parsing {p}, is_sty_file={is_sty_file}...')
-        with _open(p, self.encodings) as f:
-            f_iter = enumerate(iter(f))
-            for i, line in f_iter:
-                if _END_DOCUMENT_MARKER in line:
-                    print(f'*** Found `{line.strip()}`, stopping parsing!')
-                    break
-                # To make sure we do not parse anything commented out.
-                # We strip the comments again after copying.
-                line = strip_comments_from_line(line)
-                if not is_sty_file:
-                    line = self._extract_definition(line, f_iter)
-                    line = self._resolve_definitions(line)
-                # note that at this point, l might be multiple lines due to resolving some definition
-                for tex_file in self._included_tex_files(line):
-                    self._copy(tex_file.real_rel_path)
-                    if tex_file.needs_parse:  # false for .bst, .bib files
-                        self._parse_file(tex_file.real_rel_path)
-                for static_file in self._included_static_files(line):
-                    self._copy_static(static_file)
-
-    def _extract_definition(self, line, f_iter):
+    def glob(self, rel_pattern):
+        rel_pattern = _normpath(rel_pattern)
+        return [p for p in sorted(self.files)
+                if fnmatch.fnmatchcase(p, rel_pattern) and p.count('/') == rel_pattern.count('/')]
+
+    def listdir(self):
+        return sorted(self.files)
+
+    def write(self, rel_p, data):
+        self.files[_normpath(rel_p)] = bytes(data)
+
+    def rename(self, rel_p, new_rel_p):
+        self.files[_normpath(new_rel_p)] = self.files.pop(_normpath(rel_p))
+
+
+class _IndexedStorage(Storage):
+    """Base class for read-only storages that know all their files upfront, from `_index`."""
+    def __init__(self, prefix=''):
+        self.prefix = _normpath(prefix) if prefix else ''
+        self._index = {}  # rel_p -> (key used by `read`, size)
+        self._lock = threading.Lock()
+
+    def _add_to_index(self, path, key, size):
+        """Add `path`, relative to the root of the underlying tree, if it is in `prefix`."""
+        path = _normpath(path)
+        if self.prefix:
+            if not path.startswith(self.prefix + '/'):
+                return
+            path = path[len(self.prefix) + 1:]
+        self._index[path] = (key, size)
+
+    def _key(self, rel_p):
+        try:
+            return self._index[_normpath(rel_p)][0]
+        except KeyError:
+            raise FileNotFoundError(self.path(rel_p))
+
+    def isfile(self, rel_p):
+        return _normpath(rel_p) in self._index
+
+    def getsize(self, rel_p):
+        return self._index[_normpath(rel_p)][1]
+
+    def glob(self, rel_pattern):
+        rel_pattern = _normpath(rel_pattern)
+        return [p for p in sorted(self._index)
+                if fnmatch.fnmatchcase(p, rel_pattern) and p.count('/') == rel_pattern.count('/')]
+
+    def listdir(self):
+        return sorted(self._index)
+
+
+class GitStorage(_IndexedStorage):
+    """Read-only view of the files in directory `prefix` of commit `rev` of the git repository `repo`.
+
+    The tree listing of the commit is used as the index. Blobs are read through one persistent
+    `git cat-file --batch` process, i.e., nothing is checked out.
+    """
+    def __init__(self, repo, rev, prefix=''):
+        super(GitStorage, self).__init__(prefix)
+        self.repo = repo
+        self.commit = self._git('rev-parse', '--verify', rev + '^{commit}').decode().strip()
+        # Format of every entry: <mode> SP <type> SP <object> SP+ <size> TAB <path> NUL
+        for entry in self._git('ls-tree', '-r', '-z', '--long', '--full-tree', self.commit).split(b'\0'):
+            if not entry:
+                continue
+            info, path = entry.decode().split('\t', 1)
+            mode, object_type, object_name, size = info.split()
+            if object_type != 'blob' or mode == '120000':  # Skip submodules and symlinks.
+                continue
+            self._add_to_index(path, object_name, int(size))
+        self._cat_file = None
+
+    def read(self, rel_p):
+        object_name, size = self._key(rel_p), self.getsize(rel_p)
+        with self._lock:
+            if self._cat_file is None:
+                self._cat_file = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=self.repo,
+                                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self._cat_file.stdin.write(object_name.encode() + b'\n')
+            self._cat_file.stdin.flush()
+            header = self._cat_file.stdout.readline()  # <object> SP <type> SP <size> LF
+            assert header.split()[2] == str(size).encode(), header
+            data = self._cat_file.stdout.read(size)
+            self._cat_file.stdout.read(1)  # LF after contents
+        return data
+
+    def path(self, rel_p):
+        return '{}:{}'.format(self.commit[:10], _normpath(os.path.join(self.prefix, rel_p)))
+
+    def cache_key(self, rel_p):
+        return 'git', self._key(rel_p)
+
+    def close(self):
+        if self._cat_file is not None:
+            self._cat_file.stdin.close()
+            self._cat_file.wait()
+            self._cat_file = None
+
+    def _git(self, *args):
+        return subprocess.check_output(('git',) + args, cwd=self.repo)
+
+
+def test_git_storage():
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        def git(*args):
+            subprocess.check_call(['git', '-c', 'user.name=t', '-c', 'user.email=t@t', *args], cwd=d,
+                                  stdout=subprocess.DEVNULL)
+        os.makedirs(os.path.join(d, 'paper', 'img'))
+        for p, content in (('paper/main.tex', '\\includegraphics{img/a}\n'), ('paper/img/a.png', 'png'),
+                           ('other.txt', 'other')):
+            with open(os.path.join(d, p), 'w') as f:
+                f.write(content)
+        git('init', '-q')
+        git('add', '.')
+        git('commit', '-q', '-m', 'init')
+        os.remove(os.path.join(d, 'paper', 'img', 'a.png'))  # Not needed, we do not read the working tree.
+        storage = GitStorage(d, 'HEAD', 'paper')
+        try:
+            assert storage.listdir() == ['img/a.png', 'main.tex']
+            bundle = build_bundle(storage, 'main.tex')
+            assert bundle.files == {'main.tex': b'\\includegraphics{img/a}\n', 'img/a.png': b'png'}
+        finally:
+            storage.close()
+
+
+# Extensions of archives that can contain MAIN_FILE, see ArchiveStorage.
+_ARCHIVE_EXTS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+
+class ArchiveStorage(_IndexedStorage):
+    """Read-only view of the files in directory `prefix` of a .zip or .tar(.gz|.bz2|.xz) archive.
+
+    The index is built from the central directory of zip files, or the member headers of tar files. Members are
+    only decompressed when they are read. Note that compressed tar files do not support random access, so reading
+    members out of order decompresses parts of the archive again.
+    """
+    def __init__(self, archive_p, prefix='', fileobj=None):
+        """
+        :param fileobj: If given, read the archive from this file object instead of from `archive_p`, which is then
+            only used for messages and to determine the format.
+        """
+        super(ArchiveStorage, self).__init__(prefix)
+        self.archive_p = archive_p
+        self._cache_keys = {}  # See cache_key.
+        if archive_p.endswith('.zip'):
+            import zipfile
+            self._zip, self._tar = zipfile.ZipFile(fileobj or archive_p), None
+            for info in self._zip.infolist():
+                if not info.is_dir():
+                    self._add_to_index(info.filename, info, info.file_size)
+        else:
+            import tarfile
+            self._zip, self._tar = None, tarfile.open(archive_p, 'r:*', fileobj=fileobj)
+            for member in self._tar.getmembers():
+                if member.isfile():
+                    self._add_to_index(member.name, member, member.size)
+
+    def read(self, rel_p):
+        key = self._key(rel_p)
+        with self._lock:
+            if self._zip is not None:
+                return self._zip.read(key)
+            return self._tar.extractfile(key).read()
+
+    def path(self, rel_p):
+        return os.path.join(self.archive_p, self.prefix, rel_p)
+
+    def cache_key(self, rel_p):
+        """:return: the SHA-256 of the member `rel_p`, such that equal files in different archives share keys."""
+        key = self._cache_keys.get(rel_p)
+        if key is None:
+            key = self._cache_keys[rel_p] = ('sha256', hashlib.sha256(self.read(rel_p)).hexdigest())
+        return key
+
+    def close(self):
+        (self._zip or self._tar).close()
+
+
+def _split_archive_path(p):
+    """
+    Split a path into an archive and a path inside of it, e.g., 'a/paper.zip/sec/main.tex' -> ('a/paper.zip',
+    'sec/main.tex'). If `p` is not in an archive, return (None, p).
+    """
+    parts = _normpath(p).split('/')
+    for i in range(1, len(parts)):
+        archive_p = '/'.join(parts[:i])
+        if archive_p.endswith(_ARCHIVE_EXTS) and os.path.isfile(archive_p):
+            return archive_p, '/'.join(parts[i:])
+    return None, p
+
+
+def test_archive_storage():
+    import tarfile
+    import tempfile
+    import zipfile
+    files = {'paper/main.tex': b'\\input{sec}\n\\includegraphics{fig}\n', 'paper/sec.tex': b'Sec\n',
+             'paper/fig.pdf': b'pdf', 'paper/unused.pdf': b'unused'}
+    with tempfile.TemporaryDirectory() as d:
+        zip_p, tar_p = os.path.join(d, 'p.zip'), os.path.join(d, 'p.tar.gz')
+        with zipfile.ZipFile(zip_p, 'w') as zf:
+            for p, data in files.items():
+                zf.writestr(p, data)
+        with open(tar_p, 'wb') as f:
+            with tarfile.open(fileobj=f, mode='w:gz') as tf:
+                for p, data in files.items():
+                    info = tarfile.TarInfo(p)
+                    info.size = len(data)
+                    tf.addfile(info, io.BytesIO(data))
+        for archive_p in (zip_p, tar_p):
+            archive_p, main_file = _split_archive_path(os.path.join(archive_p, 'paper', 'main.tex'))
+            prefix, main_file = os.path.split(main_file)
+            storage = ArchiveStorage(archive_p, prefix)
+            try:
+                bundle = build_bundle(storage, main_file)
+            finally:
+                storage.close()
+            assert sorted(bundle.files) == ['fig.pdf', 'main.tex', 'sec.tex'], bundle.files
+
+
+def _normpath(rel_p):
+    return os.path.normpath(rel_p).replace(os.path.sep, '/')
+
+
+def _copy_file(src, dst, rel_p):
+    """Copy `rel_p` from Storage `src` to Storage `dst`."""
+    if isinstance(src, LocalStorage) and isinstance(dst, LocalStorage):
+        out_p = dst.path(rel_p)
+        os.makedirs(os.path.dirname(out_p), exist_ok=True)
+        shutil.copy(src.path(rel_p), out_p)
+        return
+    dst.write(rel_p, src.read(rel_p))
+
+
+def test_memory_storage():
+    storage = MemoryStorage({'main.tex': b'a', './img/a.png': b'png', 'img/sub/a.pdf': b'pdf'})
+    assert storage.isfile('img/a.png') and storage.read('img/../main.tex') == b'a'
+    assert storage.glob('img/a.*') == ['img/a.png']
+    storage.rename('main.tex', 'paper.tex')
+    assert storage.listdir() == ['img/a.png', 'img/sub/a.pdf', 'paper.tex']
+
+
+class _Definitions(object):
+    r"""Commands defined via \newcommand, and how to resolve them.
+
+    regexes: dictionary {\command -> compiled regexes matching command invocations}
+    definitions: dictionary {\command -> (definition, num_args)
+    Example:
+      regexes = {r"\imgs":      r'(\\imgs){(.*?)}{(.*?)}',
+                 r"\imagesdir": r'(\\imagesdir){(.*?)}',
+                 r"\noargs":    r'(\\noargs)(\W|$)' }
+      definitions = {r"\imgs":      (r"\include[123]{\imagesdir{2}/#1/#2.jpg}", 2),
+                     r"\imagesdir": ("imgs_#1", 1),
+                     r"\noargs":    ("Using \imgs{hello}{world}", 0)}
+    include_triggers: commands that might include .tex files, i.e., _TEX_INCLUDE_NAMES and definitions using them.
+    added: list of the arguments of every call to `add`, in order, see Copier._file_definitions.
+    """
+    def __init__(self):
+        self.regexes = {}
+        self.definitions = {}
+        self.include_triggers = set(_TEX_INCLUDE_NAMES)
+        self.added = []
+        self._snapshot = None  # See snapshot.
+
+    def copy(self):
+        """:return: a copy of the current definitions, without `added`."""
+        definitions = _Definitions()
+        definitions.regexes = dict(self.regexes)
+        definitions.definitions = dict(self.definitions)
+        definitions.include_triggers = set(self.include_triggers)
+        return definitions
+
+    def snapshot(self):
+        """:return: a copy of the current definitions, which is shared until the definitions change. Do not modify it,
+        but `copy` it first."""
+        if self._snapshot is None:
+            self._snapshot = self.copy()
+        return self._snapshot
+
+    def might_include(self, line):
+        """:return: False if resolving `line` cannot result in an include of a .tex file."""
+        return any(trigger in line for trigger in self.include_triggers)
+
+    def extract(self, line, f_iter):
+        """Add the definition in `line`, if any.
+        :return: the rest of the line after the definition (which might span multiple lines of `f_iter`)."""
+        if 'newcommand' not in line:  # Fast path, most lines define nothing.
+            return line
         m = _RE_NEWCOMMAND.search(line)
         if not m:
             return line
@@ -300,13 +1448,13 @@ class Copier(object):
         # Extract:
         is_renew, command_name, num_args = m.group(1) is not None, m.group(2), m.group(4)
 
-        if command_name in self._regexes:
+        if command_name in self.regexes:
             # This is a LaTeX syntax error but detecting it here anyway.
             if not is_renew:
                 raise ParseException('Redefining {}'.format(command_name))
             # remove previous
-            del self._regexes[command_name]
-            del self._command_definitions[command_name]
+            del self.regexes[command_name]
+            del self.definitions[command_name]
 
         if num_args is None:
             num_args = 0
@@ -317,23 +1465,679 @@ class Copier(object):
             regex = '(\\' + command_name + ')' + r'{(.*?)}' * num_args
 
         print(f'--- Compilinig {command_name}: {regex}; Command:\n{command}\n---')
-        self._regexes[command_name] = re.compile(regex)
-        self._command_definitions[command_name] = (command, num_args)
-
+        self.add(command_name, re.compile(regex), command, num_args)
         return remaining_line
 
+    def add(self, command_name, regex, command, num_args):
+        self._snapshot = None
+        self.added.append((command_name, regex, command, num_args))
+        self.regexes[command_name] = regex
+        self.definitions[command_name] = (command, num_args)
+        # Also commands defined earlier might now include files, e.g., \a -> \b, where \b is defined as \input{b}.
+        new_triggers = [command_name]
+        while new_triggers:
+            trigger = new_triggers.pop()
+            if trigger in self.include_triggers or not any(t in self.definitions[trigger][0]
+                                                           for t in self.include_triggers):
+                continue
+            self.include_triggers.add(trigger)
+            new_triggers.extend(name for name, (c, _) in self.definitions.items()
+                                if name not in self.include_triggers and trigger in c)
+
+    def resolve(self, s):
+        """
+        :param s: string to replace in
+        :return: s with every used definition replaced
+        """
+        # replacement function used for re.sub, mapping regex match to string
+        repl = self._replace_defs_for_match
+        for r in self.regexes.values():
+            s = r.sub(repl, s)
+        return s
+
+    def _replace_defs_for_match(self, match):
+        command = match.group(1)
+        definition, num_args = self.definitions[command]
+        if num_args > 0:
+            # regex is (\command){(.*?)}{(.*?)}{...} -> groups 1 to end are arguments to \command
+            args = match.groups()[1:]
+            # This would actually be a LaTeX syntax error, so is not really expected.
+            assert_exc(
+                    len(args) == num_args,
+                    'Expected {} to be invoced with {} arguments, got {}'.format(command, num_args, match.group()),
+                    ParseException)
+            # Replace #1, #2, #3 in the command definition with the actual arguments provided
+            replacements = {'#' + str(i+1): arg for i, arg in enumerate(args)}
+            activated_definition = _replace_all(definition, replacements)
+        else:
+            # regex is (\command)(\W|$), where the (\W|$) matches the non-word character following \command.
+            # Note sure how conformant this is with LaTeX syntax.
+            activated_definition = definition + match.group(2)
+        # recursion: make sure any definitions used within definitions are covered
+        return self.resolve(activated_definition)
+
+    def to_json(self):
+        return {'regexes': {name: regex.pattern for name, regex in self.regexes.items()},
+                'definitions': self.definitions,
+                'include_triggers': sorted(self.include_triggers)}
+
+    @staticmethod
+    def from_json(d):
+        definitions = _Definitions()
+        definitions.regexes = {name: re.compile(regex) for name, regex in d['regexes'].items()}
+        definitions.definitions = {name: tuple(definition) for name, definition in d['definitions'].items()}
+        definitions.include_triggers = set(d['include_triggers'])
+        return definitions
+
+
+class Copier(object):
+    def __init__(self, encodings, tex_root_file, out_dir=None, src=None, dst=None, text_cache=None,
+                 asset_cache=None, preamble_cache=None):
+        """
+        :param src: Storage with the LaTeX project, where `tex_root_file` is relative to the root of `src`. If None,
+            the directory of `tex_root_file` on disk is used.
+        :param dst: Storage to write the output to. If None, `out_dir` on disk is used.
+        :param text_cache: optional _TextCache, to share decoded files between Copiers.
+        :param asset_cache: optional _AssetCache, to share converted static files between runs.
+        :param preamble_cache: optional _PreambleCache, to reuse the definitions of the preamble between runs.
+        """
+        self.encodings = encodings
+        self._text_cache = text_cache
+        self._asset_cache = asset_cache
+        self._preamble_cache = preamble_cache
+        # Key of the snapshot to save when \begin{document} of the main file is reached, see _parse_main_file.
+        self._preamble_key_to_save = None
+        # While parsing a preamble to save, the results of all file lookups of _isfile and _glob, and the commands of
+        # all static includes that literally appear in the source, for _add_pdf_pages.
+        self._lookups = None
+        self._literal_includes = None
+        if src is None:
+            src = LocalStorage(os.path.dirname(os.path.abspath(tex_root_file)))
+            tex_root_file = os.path.basename(tex_root_file)
+        self.src = src
+        self.tex_root_dir = src.root  # None if src is not on disk.
+        # Relative to tex_root_dir.
+        self.tex_root_p = tex_root_file
+        assert src.isfile(self.tex_root_p)
+
+        self.dst = dst if dst is not None else LocalStorage(os.path.abspath(out_dir))
+        self.out_dir = self.dst.root
+
+        self._convert_jpg_exts = []  # [] if not set!
+        self._jpg_quality = 95
+        self._strip_envs = ()
+        # If False, only build the include graph in _file_deps, without writing to dst, see copy_variant.
+        self._copy_while_parsing = True
+        # Include graph: dictionary {relative_p -> list of Dependency}, filled by _parse_file. Every file is parsed
+        # at most once, later includes of the same file are replayed from here.
+        self._file_deps = {}
+        # Definitions made by every parsed file and the files it includes, in order: dictionary
+        # {relative_p -> list of arguments of _Definitions.add}. Replayed together with `_file_deps`, such that the
+        # definitions are known when a file is included again with other definitions, e.g., by another variant.
+        self._file_definitions = {}
+        # Files that are currently being parsed, outermost first, to detect include cycles.
+        self._parse_stack = []
+        # Dependency list and open environments of the line that is currently parsed.
+        self._current = ([], ())
+        # Converted static files, shared between variants: dictionary {(real_path, params) -> (cached_p, bytes)},
+        # see _write_converted.
+        self._converted = {}
+        # For extract_pdf_pages: dictionary {real_path -> set of used pages, or None if all pages are needed}, and
+        # dictionary {tex_path -> real_path} of the PDFs.
+        self._extract_pdf_pages = False
+        self._pdf_pages = {}
+        self._pdf_tex_paths = {}
+        self._copied_file_ps = set()  # Relative to out_dir.
+        # Files that were copied while parsing, with their dependencies: the `visited` set of _copy_deps for the whole
+        # run, such that repeated includes are not copied again.
+        self._copied_deps = set()
+        # Detected encoding of every file read so far, see _decode_text.
+        self._file_encodings = {}
+        self._definitions = _Definitions()
+
+    def copy(self, store_git_hash=False, rename=None, flatten=False, extract_pdf_pages=False, parse_workers=1,
+             optimize_pdfs=None):
+        """Copy main file recursively.
+
+        :param flatten: If True, write a single main file where every .tex file included via \\input or \\subfile
+            is expanded in place, instead of copying the included .tex files.
+        :param extract_pdf_pages: If True, only keep the pages of included PDFs that are used with
+            \\includegraphics[page=N], and update the page options accordingly. Needs pypdf.
+        :param parse_workers: If > 1, parse the .tex files on that many processes, with the same result as parsing
+            sequentially, see _parse_parallel. Ignored with `flatten`. The preamble cache is not used then.
+        :param optimize_pdfs: If given, a maximum DPI. All copied PDFs are then optimized, see _optimize_pdf.
+            Needs pypdf, and Pillow to downsample images.
+        """
+        main_file_out = self.copy_to_dst(store_git_hash, rename, flatten, extract_pdf_pages, parse_workers,
+                                         optimize_pdfs)
+        return self.dst.path(main_file_out)
+
+    def copy_to_dst(self, store_git_hash=False, rename=None, flatten=False, extract_pdf_pages=False,
+                    parse_workers=1, optimize_pdfs=None):
+        """Like `copy`, but returns the path of the main file relative to `dst`."""
+        main_file_out = self.tex_root_p
+        self._extract_pdf_pages = extract_pdf_pages
+        if flatten:
+            self._flatten(main_file_out)
+        elif parse_workers > 1:
+            self._copy(self.tex_root_p)
+            self._parse_parallel(parse_workers)
+            self._copy_deps(self.tex_root_p, visited=set())
+        else:
+            self._copy(self.tex_root_p)  # TODO: maybe copy and strip
+            self._parse_main_file()
+        if extract_pdf_pages:
+            self._reduce_pdfs()
+        if optimize_pdfs:
+            self._optimize_pdfs(optimize_pdfs)
+        if store_git_hash:
+            self._store_git_hash(main_file_out)
+        if rename:
+            main_file_out = self._rename_main_file(main_file_out, rename)
+        return main_file_out
+
+    def _rename_main_file(self, main_file_out, rename):
+        _, ext = os.path.splitext(rename)
+        if not ext:
+            rename += '.tex'
+        self.dst.rename(main_file_out, rename)
+        self._copied_file_ps.remove(main_file_out)
+        self._copied_file_ps.add(rename)
+        return rename
+
+    def copied_files(self):
+        """:return: paths of all files written to `dst`, relative to `dst`, sorted."""
+        return sorted(self._copied_file_ps)
+
+    def _store_git_hash(self, main_file_out):
+        git_hash = self._get_git_hash()
+        if git_hash:
+            print('Writing git hash {}...'.format(git_hash))
+            text, encoding = _decode_text(self.dst.read(main_file_out), main_file_out, self.encodings)
+            self.dst.write(main_file_out, ('% ' + git_hash + '\n' + text).encode(encoding))
+
+    def _get_git_hash(self):
+        if isinstance(self.src, GitStorage):
+            return self.src.commit
+        repo = self.tex_root_dir
+        if repo is None:
+            return None
+        try:
+            git_commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo).decode()
+            return git_commit.strip()
+        except subprocess.CalledProcessError:
+            return None
+
+    def copied_file_sizes(self):
+        return [(self.dst.getsize(p) // 1028, self.dst.path(p)) for p in self._copied_file_ps]
+
+    def _flatten(self, main_file_out):
+        print('Flattening', self.tex_root_p, '...')
+        fout = io.StringIO()
+        out = _FlatWriter(fout)
+        self._parse_file(self.tex_root_p, out=out)
+        # Keep the encoding of the main file, which is the one inputenc expects. Inlined files must have the same
+        # bytes in it, which is the case for ASCII files detected as UTF-8, for example.
+        _, encoding = out.texts[self.tex_root_p]
+        for relative_p, (text, file_encoding) in sorted(out.texts.items()):
+            try:
+                same_bytes = text.encode(_without_bom(file_encoding)) == text.encode(_without_bom(encoding))
+            except UnicodeEncodeError:
+                same_bytes = False
+            if not same_bytes:
+                raise ParseException('Cannot flatten {} ({}) into {} ({}), the encodings differ.'.format(
+                        relative_p, file_encoding, self.tex_root_p, encoding))
+        self.dst.write(main_file_out, fout.getvalue().encode(encoding))
+        self._copied_file_ps.add(main_file_out)
+
+    def _read_text(self, relative_p):
+        """:return: tuple (text, encoding) of the file at `relative_p` in `src`."""
+        key = None
+        if self._text_cache is not None:
+            key = self.src.cache_key(relative_p)
+            key = key and (key, tuple(self.encodings))
+            text_and_encoding = self._text_cache.get(key)
+            if text_and_encoding:
+                return text_and_encoding
+        text_and_encoding = _decode_text(self.src.read(relative_p), relative_p, self.encodings,
+                                         self._file_encodings)
+        if key:
+            self._text_cache.put(key, text_and_encoding)
+        return text_and_encoding
+
+    def _parse_main_file(self):
+        """Parse the main file. With a preamble cache, the definitions and includes of the preamble are loaded from a
+        snapshot if possible, and parsing starts at \\begin{document}. Otherwise, a snapshot is saved."""
+        key = self._preamble_key() if self._preamble_cache is not None else None
+        snapshot = self._preamble_cache.load(key, self.src) if key else None
+        if snapshot is not None:
+            try:
+                definitions = _Definitions.from_json(snapshot['definitions'])
+                file_deps = {relative_p: [_dependency_from_json(dep) for dep in deps]
+                             for relative_p, deps in snapshot['file_deps'].items()}
+                literal_includes = set(snapshot['literal_includes'])
+            except (KeyError, TypeError, ValueError) as e:
+                print('*** Invalid preamble snapshot ({!r}), not using it.'.format(e))
+                snapshot = None
+        if snapshot is None:
+            self._preamble_key_to_save = key
+            if key:
+                self._lookups, self._literal_includes = {'isfile': {}, 'glob': {}}, set()
+            self._parse_file(self.tex_root_p)
+            self._lookups = self._literal_includes = None
+            return
+        self._definitions = definitions
+        self._file_deps.update(file_deps)
+        if self._extract_pdf_pages:
+            for deps in file_deps.values():
+                for dep in deps:
+                    if isinstance(dep.file, StaticFile):
+                        self._add_pdf_pages(dep.file, is_literal=dep.file.command in literal_includes)
+        preamble_deps = self._file_deps.pop(self.tex_root_p)
+        if self._copy_while_parsing:
+            self._copy_deps(self.tex_root_p, visited=set(), deps=preamble_deps)
+        self._parse_file(self.tex_root_p, preamble_deps=preamble_deps)
+
+    def _preamble_key(self):
+        """:return: key of the comment stripped preamble of the main file, or None if there is no
+        \\begin{document}."""
+        h = hashlib.sha256('{} {} {}'.format(_PREAMBLE_SNAPSHOT_VERSION, self.src.root, self.tex_root_p).encode())
+        h.update(repr(self.encodings).encode())
+        text, _ = self._read_text(self.tex_root_p)
+        for line in io.StringIO(text, newline=None):
+            line = strip_comments_from_line(line)
+            if _BEGIN_DOCUMENT_MARKER in line:
+                return h.hexdigest()
+            h.update(line.encode())
+        return None
+
+    def _save_preamble(self, preamble_deps):
+        """Save a snapshot of the current definitions, where `preamble_deps` are the dependencies of the preamble of
+        the main file, and all other files parsed so far belong to the preamble."""
+        key, self._preamble_key_to_save = self._preamble_key_to_save, None
+        lookups, self._lookups = self._lookups, None
+        literal_includes, self._literal_includes = self._literal_includes, None
+        file_deps = dict(self._file_deps)
+        file_deps[self.tex_root_p] = preamble_deps
+        self._preamble_cache.save(key, {
+            'files': {relative_p: hashlib.sha256(self.src.read(relative_p)).hexdigest()
+                      for relative_p in file_deps if relative_p != self.tex_root_p},
+            'lookups': lookups,
+            'literal_includes': sorted(literal_includes),
+            'definitions': self._definitions.to_json(),
+            'file_deps': {relative_p: [_dependency_to_json(dep) for dep in deps]
+                          for relative_p, deps in file_deps.items()},
+        })
+
+    def _parse_file(self, relative_p, out=None, body_only=False, preamble_deps=None):
+        """
+        :param out: If given, a _FlatWriter. All (comment stripped) lines are written to it, and .tex files
+            included via _INLINE_INCLUDES are parsed into it instead of being copied.
+        :param body_only: If True, do not write anything before \\begin{document} to `out`.
+        :param preamble_deps: If given, the dependencies of everything before \\begin{document}, which is skipped.
+        """
+        # if '.sty' in relative_p:
+        #     print('Skipping', relative_p)
+        #     return
+        if self._is_cycle(relative_p):
+            return
+        if out is None and relative_p in self._file_deps:
+            print(f'*** Already parsed {relative_p}, replaying its includes...')
+            for added in self._file_definitions.get(relative_p, ()):
+                self._definitions.add(*added)
+            if self._copy_while_parsing and relative_p not in self._copied_deps:
+                self._copy_deps(relative_p, self._copied_deps)
+            return
+        p = self.src.path(relative_p)
+        is_sty_file = relative_p.endswith('.sty')
+        print(f'Parsing {p}, is_sty_file={is_sty_file}...')
+        parent = self._current
+        definitions, num_added = self._definitions, len(self._definitions.added)
+        self._parse_stack.append(relative_p)
+        try:
+            self._parse_lines(relative_p, is_sty_file, out, body_only, preamble_deps)
+        finally:
+            self._parse_stack.pop()
+            self._current = parent
+        if self._definitions is definitions:  # Not the case if loaded from a preamble snapshot.
+            self._file_definitions[relative_p] = definitions.added[num_added:]
+
+    def _is_cycle(self, relative_p):
+        """:return: True if `relative_p` is a package that is already being parsed.
+        :raise ParseException: if `relative_p` is any other file that is already being parsed."""
+        if relative_p not in self._parse_stack:
+            return False
+        chain = ' -> '.join(self._parse_stack + [relative_p])
+        if relative_p.endswith(('.sty', '.cls')):  # LaTeX loads every package once, so this is fine.
+            print(f'*** Include cycle, not parsing {relative_p} again: {chain}')
+            return True
+        raise ParseException(f'Include cycle: {chain}')
+
+    def _parse_parallel(self, workers):
+        """Build the include graph `_file_deps` in two phases, with the same result as parsing sequentially.
+
+        1. `_scan_definitions`: A sequential pass over all .tex files in document order, which only adds definitions
+           and follows includes. For every file, it records the definitions where the file is included, and after
+           every line that includes other files.
+        2. `_scan_text`: Every file is parsed on a pool of `workers` processes, starting from these definitions.
+        Files are then copied in document order by replaying `_file_deps`, see copy_to_dst.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        scans = OrderedDict()  # relative_p -> (text, definitions where included, {line -> definitions after line})
+        self._scan_definitions(self.tex_root_p, scans)
+        args = [(text, relative_p.endswith('.sty'), definitions, definitions_after)
+                for relative_p, (text, definitions, definitions_after) in scans.items()]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(_scan_text, *zip(*args), chunksize=max(1, len(args) // (4 * workers)))
+            for relative_p, includes in zip(scans, results):
+                deps = (self._dependency_for_include(include, relative_p.endswith('.tex')) for include in includes)
+                self._file_deps[relative_p] = [dep for dep in deps if dep is not None]
+
+    def _scan_definitions(self, relative_p, scans):
+        """Phase 1 of _parse_parallel, for `relative_p` and all .tex files it includes.
+
+        Only lines that might include a file are resolved, and .sty files are not searched for definitions, like in
+        `_parse_line`.
+        :param scans: OrderedDict, see _parse_parallel. Also used as the set of files that were already scanned.
+        """
+        if self._is_cycle(relative_p) or relative_p in scans:
+            return
+        is_sty_file = relative_p.endswith('.sty')
+        text, _ = self._read_text(relative_p)
+        definitions_after = {}
+        scans[relative_p] = (text, self._definitions.snapshot(), definitions_after)
+        f_iter = enumerate(io.StringIO(text, newline=None))
+        self._parse_stack.append(relative_p)
+        try:
+            for i, line in f_iter:
+                if _END_DOCUMENT_MARKER in line:
+                    break
+                line = strip_comments_from_line(line)
+                if not is_sty_file:
+                    line = self._definitions.extract(line, f_iter)
+                if not self._definitions.might_include(line):
+                    continue
+                if not is_sty_file:
+                    line = self._definitions.resolve(line)
+                tex_files = [tex_file for tex_file in self._included_tex_files(line) if tex_file.needs_parse]
+                for tex_file in tex_files:
+                    self._scan_definitions(tex_file.real_rel_path, scans)
+                if tex_files:
+                    definitions_after[i] = self._definitions.snapshot()
+        finally:
+            self._parse_stack.pop()
+
+    def _dependency_for_include(self, include, is_tex_file):
+        """:return: the Dependency for an include found by `_scan_text` in a .tex file if `is_tex_file`, or None if
+        the file does not exist and is not required to exist, like in `_included_tex_files`."""
+        if include[0] == 'tex':
+            _, include_command_index, tex_path, envs = include
+            include_command = _TEX_INCLUDES[include_command_index]
+            real_rel_path = self._real_rel_path_for_tex_file(
+                    tex_path, include_command.possible_extensions, include_command.must_exist)
+            return Dependency(TexFile(real_rel_path, include_command.needs_parse), envs) if real_rel_path else None
+        _, tex_path, options, command, is_literal, envs = include
+        static_file = StaticFile(tex_path, self._real_path_for_static_file(tex_path), options, command)
+        if self._extract_pdf_pages:
+            self._add_pdf_pages(static_file, is_literal and is_tex_file)
+        return Dependency(static_file, envs)
+
+    def _parse_lines(self, relative_p, is_sty_file, out, body_only, preamble_deps=None):
+        in_body = not body_only
+        deps = self._file_deps[relative_p] = list(preamble_deps or [])
+        in_preamble = preamble_deps is not None
+        envs = []
+        text, encoding = self._read_text(relative_p)
+        if out is not None:
+            out.texts[relative_p] = (text, encoding)
+        f_iter = _RecordingIter(enumerate(io.StringIO(text, newline=None)))
+        for i, line in f_iter:
+            if _END_DOCUMENT_MARKER in line:
+                print(f'*** Found `{line.strip()}`, stopping parsing!')
+                if out is not None and not body_only:
+                    out.write(line)
+                break
+            # To make sure we do not parse anything commented out.
+            # We strip the comments again after copying.
+            line = strip_comments_from_line(line)
+            if _BEGIN_DOCUMENT_MARKER in line:
+                in_preamble = False
+                if self._preamble_key_to_save and relative_p == self.tex_root_p:
+                    self._save_preamble(list(deps))
+            if in_preamble:  # Loaded from a snapshot, see _parse_main_file.
+                f_iter.pop_recorded()
+                continue
+            self._current = (deps, _update_envs(envs, line))
+            if out is None:
+                self._parse_line(line, f_iter, is_sty_file)
+                continue
+            if not in_body:
+                in_body = _BEGIN_DOCUMENT_MARKER in line
+                self._parse_line(line, f_iter, is_sty_file)
+                f_iter.pop_recorded()
+                continue
+            inline_includes = list(self._inline_includes(line))
+            if not inline_includes or _RE_NEWCOMMAND.search(line):
+                self._parse_line(line, f_iter, is_sty_file)
+                for raw_line in f_iter.pop_recorded():
+                    out.write(raw_line)
+                continue
+            # Split line into pieces around the includes, and expand the includes in place.
+            f_iter.pop_recorded()
+            start = 0
+            for m, tex_file, include_command in inline_includes:
+                out.write_piece(line[start:m.start()])
+                self._parse_line(line[start:m.start()], f_iter, is_sty_file)
+                self._parse_file(tex_file.real_rel_path, out, body_only=include_command.body_only)
+                out.end_line()
+                start = m.end()
+            out.write_piece(line[start:])
+            self._parse_line(line[start:], f_iter, is_sty_file)
+
+    def _parse_line(self, line, f_iter, is_sty_file):
+        raw_line = line
+        if not is_sty_file:
+            line = self._definitions.extract(line, f_iter)
+            line = self._definitions.resolve(line)
+        deps, envs = self._current
+        # note that at this point, l might be multiple lines due to resolving some definition
+        for tex_file in self._included_tex_files(line):
+            deps.append(Dependency(tex_file, envs))
+            # Otherwise, only the include graph is built, see copy_variant.
+            if self._copy_while_parsing and tex_file.real_rel_path not in self._copied_file_ps:
+                self._copy(tex_file.real_rel_path)
+            if tex_file.needs_parse:  # false for .bst, .bib files
+                self._parse_file(tex_file.real_rel_path)
+        for static_file in self._included_static_files(line):
+            deps.append(Dependency(static_file, envs))
+            # Only includes that literally appear in a .tex file can be updated, i.e., not the ones in definitions, or
+            # in packages, see _reduce_pdfs.
+            is_literal = static_file.command in raw_line and self._parse_stack[-1].endswith('.tex')
+            if is_literal and self._literal_includes is not None:
+                self._literal_includes.add(static_file.command)
+            if self._extract_pdf_pages:
+                self._add_pdf_pages(static_file, is_literal)
+            if self._copy_while_parsing and static_file.real_path not in self._copied_deps:
+                self._copied_deps.add(static_file.real_path)
+                self._copy_static(static_file)
+
+    def _add_pdf_pages(self, static_file, is_literal):
+        if not static_file.real_path.lower().endswith('.pdf'):
+            return
+        m = _RE_PAGE_OPTION.search(static_file.options or '')
+        page = m.group(1).strip() if m else '1'
+        pages = self._pdf_pages.setdefault(static_file.real_path, set())
+        if pages is None:
+            return
+        if not is_literal or not page.isdigit() or \
+                self._pdf_tex_paths.setdefault(static_file.tex_path, static_file.real_path) != static_file.real_path:
+            self._pdf_pages[static_file.real_path] = None
+            return
+        pages.add(int(page))
+
+    def _reduce_pdfs(self):
+        """Replace every PDF in `dst` for which only some pages are used with a PDF of these pages, and update all
+        page= options in the .tex files."""
+        try:
+            import pypdf
+        except ImportError:
+            print('*** pypdf not found, not extracting pages of PDFs (pip install pypdf).')
+            return
+        texts = {p: _decode_text(self.dst.read(p), p, self.encodings)
+                 for p in self.copied_files() if p.endswith('.tex')}
+        # The pages used via definitions are unknown (e.g. page=#1), and their page= options cannot be updated for
+        # every use, so keep all pages of PDFs that are included in a definition.
+        for text, _ in texts.values():
+            for body in _definition_bodies(text):
+                for include_command in _STATIC_INCLUDES:
+                    for m in include_command.regex.finditer(body):
+                        real_path = self._pdf_tex_paths.get(m.group(include_command.path_group))
+                        if real_path in self._pdf_pages:
+                            self._pdf_pages[real_path] = None
+        page_maps = {}  # real_path -> {old page -> new page}
+        for real_path, pages in sorted(self._pdf_pages.items()):
+            if pages is None:
+                continue
+            pages = sorted(pages)
+            reader = pypdf.PdfReader(io.BytesIO(self.src.read(real_path)))
+            if len(pages) >= len(reader.pages) or pages[-1] > len(reader.pages):
+                continue
+            print('*** Keeping pages {} of {} ({} pages)'.format(pages, real_path, len(reader.pages)))
+            self._write_converted(real_path, real_path, ('pdf_pages',) + tuple(pages),
+                                  lambda _, reader=reader, pages=pages: _select_pdf_pages(pypdf, reader, pages))
+            page_maps[real_path] = {page: i + 1 for i, page in enumerate(pages)}
+        if not page_maps:
+            return
+        for p, (text, encoding) in sorted(texts.items()):
+            new_text = text
+            for include_command in _STATIC_INCLUDES:
+                new_text = include_command.regex.sub(
+                        lambda m: self._update_page_option(m, include_command, page_maps), new_text)
+            if new_text != text:
+                self.dst.write(p, new_text.encode(encoding))
+
+    def _update_page_option(self, m, include_command, page_maps):
+        """:return: the include command matched by `m`, with page=N updated according to `page_maps`."""
+        page_map = page_maps.get(self._pdf_tex_paths.get(m.group(include_command.path_group)))
+        options = m.group(1)
+        if not page_map or not options:  # Without page=N, page 1 is used, which stays the first page.
+            return m.group(0)
+
+        def new_page_option(pm):
+            page = pm.group(1).strip()
+            if not page.isdigit() or int(page) not in page_map:
+                return pm.group(0)
+            return 'page={}'.format(page_map[int(page)])
+
+        new_options = _RE_PAGE_OPTION.sub(new_page_option, options)
+        return m.group(0).replace(options, new_options, 1)
+
+    def _optimize_pdfs(self, max_dpi):
+        """Optimize all PDFs in `dst` with _optimize_pdf, on a process pool. Every PDF is only replaced if it gets
+        smaller. Results are reused from the asset cache, if any."""
+        try:
+            import pypdf  # Only to check that the workers can import it.
+        except ImportError:
+            print('*** pypdf not found, not optimizing PDFs (pip install pypdf).')
+            return
+        from concurrent.futures import ProcessPoolExecutor
+        params = ('pdf_optimize', max_dpi)
+        originals = {p: self.dst.read(p) for p in self.copied_files() if p.lower().endswith('.pdf')}
+        cache_keys = {p: self._asset_cache.key(data, params) if self._asset_cache else None
+                      for p, data in originals.items()}
+        optimized = {}
+        for p, cache_key in cache_keys.items():
+            cached_p = cache_key and self._asset_cache.get(cache_key)
+            if cached_p:
+                with open(cached_p, 'rb') as f:
+                    optimized[p] = f.read()
+        todo = [p for p in sorted(originals) if p not in optimized]
+        if todo:
+            with ProcessPoolExecutor() as pool:
+                futures = {p: pool.submit(_optimize_pdf, originals[p], max_dpi) for p in todo}
+                for p, future in futures.items():
+                    try:
+                        optimized[p] = future.result()
+                    except Exception as e:  # pypdf fails in many ways on broken PDFs, which we then keep as they are.
+                        print('*** Could not optimize {}: {!r}'.format(p, e))
+                        continue
+                    if cache_keys[p]:
+                        self._asset_cache.put(cache_keys[p], optimized[p])
+        total_saved = 0
+        for p in sorted(optimized):
+            saved = len(originals[p]) - len(optimized[p])
+            if saved <= 0:
+                print('*** Optimizing {} saves nothing, keeping it.'.format(p))
+                continue
+            print('*** Optimized {}: {} -> {} bytes ({} bytes saved)'.format(
+                    p, len(originals[p]), len(optimized[p]), saved))
+            self.dst.write(p, optimized[p])
+            total_saved += saved
+        print('*** Optimizing PDFs saved {} bytes in total.'.format(total_saved))
+
+    def copy_variant(self, variant, dst):
+        """Write the files needed for `variant` to the Storage `dst`.
+
+        All variants of a Copier share one parse: every file is parsed at most once, and the include graph and
+        converted images are reused by all variants. Every main file is parsed with its own definitions, since, e.g.,
+        a supplement usually defines the same commands as the paper.
+        :return: tuple (main_file_out, copied_files), relative to `dst`.
+        """
+        self._copy_while_parsing = False
+        if variant.main_file not in self._file_deps:
+            self._definitions = _Definitions()
+            self._parse_file(variant.main_file)
+        c = copy.copy(self)  # Shares the include graph and caches, but writes to its own `dst`.
+        c.dst, c.out_dir, c.tex_root_p = dst, dst.root, variant.main_file
+        c._copied_file_ps = set()
+        c._strip_envs = tuple(variant.strip_envs)
+        c._convert_jpg_exts = list(variant.jpg_exts)
+        c._jpg_quality = variant.jpg_quality
+        c._extract_pdf_pages = False
+        print(f'*** Writing variant {variant.name}...')
+        c._copy(variant.main_file)
+        c._copy_deps(variant.main_file, visited=set())
+        main_file_out = variant.main_file
+        if variant.rename:
+            main_file_out = c._rename_main_file(main_file_out, variant.rename)
+        return main_file_out, c.copied_files()
+
+    def _copy_deps(self, relative_p, visited, deps=None):
+        """Copy all files that `relative_p` depends on according to the include graph, recursively.
+        :param deps: If given, use these dependencies for `relative_p` instead of the ones in the include graph."""
+        visited.add(relative_p)
+        for dep in self._file_deps[relative_p] if deps is None else deps:
+            if set(dep.envs) & set(self._strip_envs):
+                continue
+            if isinstance(dep.file, StaticFile):
+                if dep.file.real_path not in visited:
+                    visited.add(dep.file.real_path)
+                    self._copy_static(dep.file)
+                continue
+            if dep.file.real_rel_path in visited:
+                continue
+            if dep.file.real_rel_path not in self._copied_file_ps:
+                self._copy(dep.file.real_rel_path)
+            if dep.file.needs_parse:
+                self._copy_deps(dep.file.real_rel_path, visited)
+            else:
+                visited.add(dep.file.real_rel_path)
+
     def _copy(self, relative_p):
         """Copy file at `relative_p` to output. If .tex file, strip comments."""
         print('Copying', relative_p, '...')
-        p = os.path.join(self.tex_root_dir, relative_p)
-        assert os.path.isfile(p), f'Expected file at {p} (make sure this is not a directory).'
-
-        outp = os.path.join(self.out_dir, relative_p)
-        shutil.copy(p, outp)
-        self._copied_file_ps.add(outp)
-
-        if outp.endswith('.tex'):
-            strip_comments(outp)
+        assert self.src.isfile(relative_p), \
+            f'Expected file at {self.src.path(relative_p)} (make sure this is not a directory).'
+
+        if relative_p.endswith('.tex'):
+            text, encoding = self._read_text(relative_p)
+            text = ''.join(_strip_comments_from_lines(io.StringIO(text)))
+            if self._strip_envs:
+                text = _strip_environments(text, self._strip_envs)
+            self.dst.write(relative_p, text.encode(encoding))
+        else:
+            _copy_file(self.src, self.dst, relative_p)
+        self._copied_file_ps.add(relative_p)
 
     def _copy_static(self, static_file: StaticFile):
         """copy static file (images, pdfs, etc.)
@@ -343,13 +2147,12 @@ class Copier(object):
         :return:
         """
         print('*** static', static_file)
-        p = os.path.join(self.tex_root_dir, static_file.real_path)
-        out_p = os.path.join(self.out_dir, static_file.real_path)
-        os.makedirs(os.path.dirname(out_p), exist_ok=True)  # real_path might contain a dir, e.g., img/A.png
+        p = static_file.real_path
+        out_p = static_file.real_path
         _, real_ext = os.path.splitext(static_file.real_path)
         if real_ext not in self._convert_jpg_exts:
-            print('*** static -> cp', p, out_p)
-            shutil.copy(p, out_p)
+            print('*** static -> cp', self.src.path(p), self.dst.path(out_p))
+            _copy_file(self.src, self.dst, p)  # real_path might contain a dir, e.g., img/A.png
             self._copied_file_ps.add(out_p)
             return
         _, tex_ext = os.path.splitext(static_file.tex_path)
@@ -364,39 +2167,52 @@ class Copier(object):
                     'Please replace {} with {} and try again.'.format(
                             tex_path, tex_path, os.path.splitext(tex_path)[0]))
         new_out_p = os.path.splitext(out_p)[0] + '.jpg'
-        self._save_as_jpg(p, new_out_p)  # TODO: not implemented!
-
-    def _resolve_definitions(self, s):
-        """
-        :param s: string to replace in
-        :return: s with every used definition replaced
+        self._save_as_jpg(p, new_out_p)
+
+    def _save_as_jpg(self, p, out_p):
+        def convert(data):
+            print('*** static -> jpg', self.src.path(p), self.dst.path(out_p))
+            try:
+                from PIL import Image
+            except ImportError:
+                raise ParseException('Converting images to .jpg needs Pillow (pip install Pillow).')
+            jpg = io.BytesIO()
+            Image.open(io.BytesIO(data)).convert('RGB').save(jpg, 'JPEG', quality=self._jpg_quality)
+            return jpg.getvalue()
+        self._write_converted(p, out_p, ('jpg', self._jpg_quality), convert)
+
+    def _write_converted(self, p, out_p, params, convert):
+        """Write `convert(data)`, where `data` are the bytes of `p` in `src`, to `out_p` in `dst`.
+
+        Results are reused from `_converted` (within this run) and from the asset cache (between runs), where they
+        are linked to `dst` if it is on disk.
+        :param params: tuple describing the conversion, used in the cache keys.
         """
-        # replacement function used for re.sub, mapping regex match to string
-        repl = self._replace_defs_for_match
-        for r in self._regexes.values():
-            s = r.sub(repl, s)
-        return s
-
-    def _replace_defs_for_match(self, match):
-        command = match.group(1)
-        definition, num_args = self._command_definitions[command]
-        if num_args > 0:
-            # regex is (\command){(.*?)}{(.*?)}{...} -> groups 1 to end are arguments to \command
-            args = match.groups()[1:]
-            # This would actually be a LaTeX syntax error, so is not really expected.
-            assert_exc(
-                    len(args) == num_args,
-                    'Expected {} to be invoced with {} arguments, got {}'.format(command, num_args, match.group()),
-                    ParseException)
-            # Replace #1, #2, #3 in the command definition with the actual arguments provided
-            replacements = {'#' + str(i+1): arg for i, arg in enumerate(args)}
-            activated_definition = _replace_all(definition, replacements)
-        else:
-            # regex is (\command)(\W|$), where the (\W|$) matches the non-word character following \command.
-            # Note sure how conformant this is with LaTeX syntax.
-            activated_definition = definition + match.group(2)
-        # recursion: make sure any definitions used within definitions are covered
-        return self._resolve_definitions(activated_definition)
+        key = (p,) + params
+        if key not in self._converted:
+            self._converted[key] = self._convert(p, params, convert)
+        cached_p, data = self._converted[key]
+        try:
+            if cached_p is None or not isinstance(self.dst, LocalStorage):
+                raise FileNotFoundError(cached_p)
+            _link_or_copy(cached_p, self.dst.path(out_p))
+        except FileNotFoundError:  # Also if evicted from the cache in the meantime.
+            self.dst.write(out_p, data)
+        self._copied_file_ps.add(out_p)
+
+    def _convert(self, p, params, convert):
+        """:return: tuple (path in the asset cache or None, converted bytes)."""
+        data = self.src.read(p)
+        if self._asset_cache is None:
+            return None, convert(data)
+        cache_key = self._asset_cache.key(data, params)
+        cached_p = self._asset_cache.get(cache_key)
+        if cached_p is not None:
+            print('*** Using cached', cached_p, 'for', self.src.path(p))
+            with open(cached_p, 'rb') as f:
+                return cached_p, f.read()
+        converted = convert(data)
+        return self._asset_cache.put(cache_key, converted), converted
 
     def _included_tex_files(self, l):
         for m, include_command in Copier._match_all(l, _TEX_INCLUDES):
@@ -406,47 +2222,68 @@ class Copier(object):
             if real_rel_path:
                 yield TexFile(real_rel_path, include_command.needs_parse)
 
+    def _inline_includes(self, l):
+        """Yield (match, TexFile, IncludeCommand) for every .tex file included directly in `l` (i.e., not via a
+        definition) that is expanded in place with --flatten, in order of appearance."""
+        matches = sorted(Copier._match_all(l, _INLINE_INCLUDES), key=lambda m_and_c: m_and_c[0].start())
+        for m, include_command in matches:
+            tex_path = m.group(include_command.path_group)
+            real_rel_path = self._real_rel_path_for_tex_file(
+                    tex_path, include_command.possible_extensions, include_command.must_exist)
+            yield m, TexFile(real_rel_path, include_command.needs_parse), include_command
+
     def _included_static_files(self, l):
         for m, include_command in Copier._match_all(l, _STATIC_INCLUDES):
             tex_path = m.group(include_command.path_group)
             print('***', tex_path)
-            # this is actually a full fucking path
-            real_path = self._real_path_for_static_file(tex_path)
-            rel_path = real_path.replace(self.tex_root_dir, '').lstrip(os.path.sep)
-            yield StaticFile(tex_path, rel_path)
+            rel_path = self._real_path_for_static_file(tex_path)
+            yield StaticFile(tex_path, rel_path, m.group(1), m.group(0))
 
     # TODO: rename
     def _real_path_for_static_file(self, tex_path):
-        real_path = os.path.join(self.tex_root_dir, tex_path)
+        """:return: path of the file included as `tex_path`, relative to `src`."""
         _, ext = os.path.splitext(tex_path)
         if ext != '':
-            if not os.path.isfile(real_path):
-                raise ParseException('File {} does not exist!'.format(real_path))
-            return real_path
-        candidates = glob.glob(real_path + '.*')
+            if not self._isfile(tex_path):
+                raise ParseException('File {} does not exist!'.format(self.src.path(tex_path)))
+            return tex_path
+        candidates = self._glob(tex_path + '.*')
         # ==0 should not happen for a valid LaTeX
         # >1  can happen, but we do not handle it for now
         if len(candidates) != 1:
             raise ParseException(
                     'Expected exactly 1 file matching {}, got: {} (Files without extension are not supported'.format(
-                            real_path + '.*', candidates or 'None'))
+                            self.src.path(tex_path) + '.*', candidates or 'None'))
         return candidates.pop()
 
     def _real_rel_path_for_tex_file(self, tex_path, possible_extensions, must_exist):
-        real_path = os.path.join(self.tex_root_dir, tex_path)
         _, ext = os.path.splitext(tex_path)
         if ext != '':
-            if not os.path.isfile(real_path) and must_exist:
-                raise ParseException('File {} does not exist!'.format(real_path))
+            if not self._isfile(tex_path) and must_exist:
+                raise ParseException('File {} does not exist!'.format(self.src.path(tex_path)))
             return tex_path
         for possible_extension in possible_extensions:
-            if os.path.isfile(real_path + possible_extension):
+            if self._isfile(tex_path + possible_extension):
                 return tex_path + possible_extension
         if must_exist:
             raise ParseException(
                     'Expected to find file in {} starting with {} and ending with {}. Consider renaming file to match '
                     'expected extension OR filing a bug report / updating the expected extensions.'.format(
-                            self.tex_root_dir, tex_path, '|'.join(possible_extensions)))
+                            self.src.path(''), tex_path, '|'.join(possible_extensions)))
+
+    def _isfile(self, rel_p):
+        """:return: self.src.isfile(rel_p), recorded for the preamble snapshot, see _PreambleCache."""
+        exists = self.src.isfile(rel_p)
+        if self._lookups is not None:
+            self._lookups['isfile'][rel_p] = exists
+        return exists
+
+    def _glob(self, rel_pattern):
+        """:return: self.src.glob(rel_pattern), sorted, and recorded for the preamble snapshot, see _PreambleCache."""
+        matches = sorted(self.src.glob(rel_pattern))
+        if self._lookups is not None:
+            self._lookups['glob'][rel_pattern] = matches
+        return matches
 
     @staticmethod
     def _match_all(l, include_commands):
@@ -455,6 +2292,629 @@ class Copier(object):
                 yield m, include_command
 
 
+def _scan_text(text, is_sty_file, definitions, definitions_after):
+    """Phase 2 of Copier._parse_parallel, run in worker processes: find all includes in `text`, like `_parse_line`.
+
+    :param definitions: _Definitions where the file is included.
+    :param definitions_after: dictionary {line index -> _Definitions after that line}, for lines including files.
+    :return: list of includes, in order, where paths are not resolved yet, see Copier._dependency_for_include:
+        ('tex', index in _TEX_INCLUDES, tex_path, envs) or ('static', tex_path, options, command, is_literal, envs).
+    """
+    includes = []
+    envs = []
+    # Snapshots are shared between the files of a chunk of pool.map, so never modify them.
+    definitions = definitions.copy()
+    f_iter = enumerate(io.StringIO(text, newline=None))
+    for i, line in f_iter:
+        if _END_DOCUMENT_MARKER in line:
+            break
+        line = strip_comments_from_line(line)
+        line_envs = _update_envs(envs, line)
+        raw_line = line
+        if not is_sty_file:
+            line = definitions.extract(line, f_iter)
+            line = definitions.resolve(line)
+        for m, include_command in Copier._match_all(line, _TEX_INCLUDES):
+            includes.append(('tex', _TEX_INCLUDES.index(include_command), m.group(include_command.path_group),
+                             line_envs))
+        for m, include_command in Copier._match_all(line, _STATIC_INCLUDES):
+            includes.append(('static', m.group(include_command.path_group), m.group(1), m.group(0),
+                             m.group(0) in raw_line, line_envs))
+        if i in definitions_after:
+            definitions = definitions_after[i].copy()
+    return includes
+
+
+def _definition_bodies(text):
+    r""":return: list of the bodies of all \newcommand and \renewcommand definitions in `text`."""
+    bodies = []
+    lines = enumerate(text.splitlines(True))
+    for _, line in lines:
+        m = _RE_NEWCOMMAND.search(line) if 'newcommand' in line else None
+        while m:
+            line = line[m.end() - 1:]
+            if not line.endswith('\n'):
+                line += '\n'
+            try:
+                body, line = _consume_until_closing_bracket(line, lines)
+            except ValueError:
+                break
+            bodies.append(body)
+            m = _RE_NEWCOMMAND.search(line)
+    return bodies
+
+
+def _select_pdf_pages(pypdf, reader, pages):
+    """:return: bytes of a PDF with the given (1-based) `pages` of the pypdf.PdfReader `reader`."""
+    writer = pypdf.PdfWriter()
+    for page in pages:
+        writer.add_page(reader.pages[page - 1])
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+def _optimize_pdf(data, max_dpi):
+    """Run in the worker processes of Copier._optimize_pdfs.
+
+    Compresses all page content streams, downsamples images above `max_dpi` (if Pillow is available), removes
+    duplicated and unused objects, and the metadata.
+    :return: the bytes of the optimized PDF.
+    """
+    import pypdf
+    writer = pypdf.PdfWriter(clone_from=pypdf.PdfReader(io.BytesIO(data)))
+    for page in writer.pages:
+        page.compress_content_streams(level=9)
+        _downsample_images(page, max_dpi)
+    writer.compress_identical_objects()  # Before removing the metadata, which older pypdf needs.
+    writer.metadata = None
+    writer.xmp_metadata = None
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+def _downsample_images(page, max_dpi):
+    """Downsample all images of `page` that have more than `max_dpi` at the size they are drawn at, see
+    _image_sizes. Images drawn more than once keep the resolution needed for the largest one. For images whose size is
+    unknown (inline images, images in form XObjects), the size of the page is used."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return
+    page_size = (float(page.mediabox.width) / 72, float(page.mediabox.height) / 72)
+    sizes = _image_sizes(page)
+    for name in page.images.keys():
+        image_file = page.images[name]
+        w_in, h_in = sizes.get(name, page_size) if isinstance(name, str) else page_size
+        try:
+            image = image_file.image
+            scale = min(max_dpi * w_in / image.width, max_dpi * h_in / image.height)
+            if scale >= 1:
+                continue
+            size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            image_file.replace(image.resize(size, Image.LANCZOS))
+        except (NotImplementedError, ValueError, OSError) as e:  # Unsupported image formats are kept.
+            print('*** Not downsampling {}: {!r}'.format(image_file.name, e))
+
+
+def _image_sizes(page):
+    """:return: dictionary {XObject name -> (width, height) in inches}, of the largest size every XObject is drawn at
+    by the content stream of `page` (the unit square transformed by the current transformation matrix)."""
+    contents = page.get_contents()
+    if contents is None:
+        return {}
+    sizes = {}
+    ctm, stack = (1, 0, 0, 1, 0, 0), []
+    for operands, operator in contents.operations:
+        if operator == b'q':
+            stack.append(ctm)
+        elif operator == b'Q' and stack:
+            ctm = stack.pop()
+        elif operator == b'cm' and len(operands) == 6:
+            a, b, c, d, e, f = (float(x) for x in operands)
+            ctm = (a * ctm[0] + b * ctm[2], a * ctm[1] + b * ctm[3], c * ctm[0] + d * ctm[2], c * ctm[1] + d * ctm[3],
+                   e * ctm[0] + f * ctm[2] + ctm[4], e * ctm[1] + f * ctm[3] + ctm[5])
+        elif operator == b'Do' and operands:
+            w_in, h_in = math.hypot(ctm[0], ctm[1]) / 72, math.hypot(ctm[2], ctm[3]) / 72
+            old_w_in, old_h_in = sizes.get(operands[0], (0, 0))
+            sizes[operands[0]] = (max(w_in, old_w_in), max(h_in, old_h_in))
+    return sizes
+
+
+# Result of `build_bundle`.
+# main_file: path of the main file in `files`.
+# manifest: list of tuples (path, size in bytes), sorted by path.
+# files: dictionary {path -> bytes}.
+Bundle = namedtuple('Bundle', ['main_file', 'manifest', 'files'])
+
+
+def build_bundle(src, main_file, encodings=('utf-8',), store_git_hash=False, rename=None, flatten=False,
+                 extract_pdf_pages=False, text_cache=None, asset_cache=None, parse_workers=1, optimize_pdfs=None,
+                 preamble_cache=None):
+    """Run Copier entirely in memory, without writing to disk.
+
+    :param src: Storage with the LaTeX project, or a directory on disk. `main_file` is relative to it.
+    :param text_cache: optional _TextCache, see Copier.
+    :param asset_cache: optional _AssetCache, see Copier.
+    :param preamble_cache: optional _PreambleCache, see Copier.
+    :return: Bundle
+    """
+    if not isinstance(src, Storage):
+        src = LocalStorage(os.path.abspath(src))
+    dst = MemoryStorage()
+    c = Copier(list(encodings), main_file, src=src, dst=dst, text_cache=text_cache, asset_cache=asset_cache,
+               preamble_cache=preamble_cache)
+    main_file_out = c.copy_to_dst(store_git_hash, rename, flatten, extract_pdf_pages, parse_workers, optimize_pdfs)
+    files = {p: dst.read(p) for p in c.copied_files()}
+    return Bundle(main_file_out, [(p, len(data)) for p, data in sorted(files.items())], files)
+
+
+def build_variants(src, variants, encodings=('utf-8',), asset_cache=None):
+    """Like `build_bundle` for every Variant in `variants`, where files shared between variants are parsed once.
+
+    :return: dictionary {variant name -> Bundle}
+    """
+    if not isinstance(src, Storage):
+        src = LocalStorage(os.path.abspath(src))
+    c = Copier(list(encodings), variants[0].main_file, src=src, dst=MemoryStorage(), asset_cache=asset_cache)
+    bundles = {}
+    for variant in variants:
+        dst = MemoryStorage()
+        main_file_out, copied_files = c.copy_variant(variant, dst)
+        files = {p: dst.read(p) for p in copied_files}
+        bundles[variant.name] = Bundle(main_file_out, [(p, len(data)) for p, data in sorted(files.items())], files)
+    return bundles
+
+
+def test_extract_pdf_pages():
+    import tempfile
+    try:
+        import pypdf
+    except ImportError:
+        return
+    pdf = io.BytesIO()
+    writer = pypdf.PdfWriter()
+    for width in range(100, 110):  # Page N has width 99 + N.
+        writer.add_blank_page(width, 100)
+    writer.write(pdf)
+    src = MemoryStorage({'main.tex': b'\\includegraphics[width=1cm,page=7]{plots}\n'
+                                     b'\\includegraphics[page=3]{plots.pdf}\n\\includegraphics{single.pdf}\n',
+                         'plots.pdf': pdf.getvalue(), 'single.pdf': pdf.getvalue()})
+    bundle = build_bundle(src, 'main.tex', extract_pdf_pages=True)
+    assert bundle.files['main.tex'] == (b'\\includegraphics[width=1cm,page=2]{plots}\n'
+                                        b'\\includegraphics[page=1]{plots.pdf}\n\\includegraphics{single.pdf}\n')
+    reduced = pypdf.PdfReader(io.BytesIO(bundle.files['plots.pdf']))
+    assert [int(page.mediabox.width) for page in reduced.pages] == [102, 106]
+    assert len(pypdf.PdfReader(io.BytesIO(bundle.files['single.pdf'])).pages) == 1
+    # PDFs included in definitions keep all pages, and their page= options stay as they are.
+    main = (b'\\newcommand{\\p}{\\includegraphics[page=3]{plots}}\n\\includegraphics[page=1]{plots}\n'
+            b'\\newcommand{\\q}[1]{\\includegraphics[page=#1]{other}}\n\\includegraphics[page=2]{other}\n')
+    src = MemoryStorage({'main.tex': main, 'plots.pdf': pdf.getvalue(), 'other.pdf': pdf.getvalue()})
+    bundle = build_bundle(src, 'main.tex', extract_pdf_pages=True)
+    assert bundle.files['main.tex'] == main
+    assert bundle.files['plots.pdf'] == bundle.files['other.pdf'] == pdf.getvalue()
+    # Only .tex files are updated, so PDFs included in other files keep all pages.
+    src = MemoryStorage({'main.tex': b'\\usepackage{logos}\n\\includegraphics[page=1]{logo}\n',
+                         'logos.sty': b'\\def\\logo{\\includegraphics[page=3]{logo}}\n', 'logo.pdf': pdf.getvalue()})
+    for parse_workers in (1, 2):
+        bundle = build_bundle(src, 'main.tex', extract_pdf_pages=True, parse_workers=parse_workers)
+        assert bundle.files['logo.pdf'] == pdf.getvalue() and bundle.files['logos.sty'] == src.read('logos.sty')
+    # Pages used in the preamble are kept when it is loaded from a snapshot, too.
+    src = MemoryStorage({'main.tex': b'\\titlegraphic{\\includegraphics{logo.pdf}}\n\\begin{document}\n'
+                                     b'\\includegraphics[page=2]{logo}\n\\end{document}\n',
+                         'logo.pdf': pdf.getvalue()})
+    with tempfile.TemporaryDirectory() as d:
+        for _ in range(2):
+            bundle = build_bundle(src, 'main.tex', extract_pdf_pages=True, preamble_cache=_PreambleCache(d))
+            reduced = pypdf.PdfReader(io.BytesIO(bundle.files['logo.pdf']))
+            assert [int(page.mediabox.width) for page in reduced.pages] == [100, 101]
+
+
+def test_optimize_pdfs():
+    try:
+        import pypdf
+        from pypdf.generic import DecodedStreamObject, NameObject
+    except ImportError:
+        return
+    writer = pypdf.PdfWriter()
+    page = writer.add_blank_page(100, 100)
+    content = DecodedStreamObject()
+    content.set_data(b'0 0 m 100 100 l S\n' * 100)  # Uncompressed, like many exported plots.
+    page[NameObject('/Contents')] = writer._add_object(content)
+    writer.add_metadata({'/Producer': 'plotting library'})
+    plot = io.BytesIO()
+    writer.write(plot)
+    src = MemoryStorage({'main.tex': b'\\includegraphics{plot}\n\\includegraphics{broken}\n',
+                         'plot.pdf': plot.getvalue(), 'broken.pdf': b'not a pdf'})
+    bundle = build_bundle(src, 'main.tex', optimize_pdfs=150)
+    assert len(bundle.files['plot.pdf']) < len(plot.getvalue())
+    # The size images are drawn at, where /Im1 is drawn twice, once rotated by 90 degrees.
+    content.set_data(b'q 72 0 0 144 0 0 cm /Im0 Do Q q 0.5 0 0 0.5 0 0 cm q 0 144 -72 0 0 0 cm /Im1 Do Q '
+                     b'36 0 0 36 0 0 cm /Im1 Do Q')
+    assert _image_sizes(page) == {'/Im0': (1, 2), '/Im1': (1, 0.5)}
+    optimized = pypdf.PdfReader(io.BytesIO(bundle.files['plot.pdf']))
+    assert optimized.metadata is None and b'100 100 l' in optimized.pages[0].get_contents().get_data()
+    assert bundle.files['broken.pdf'] == b'not a pdf'
+
+
+def write_tar(files, fileobj):
+    """Write dictionary {path -> bytes} `files`, e.g., Bundle.files, as a tar archive to the file object `fileobj`.
+
+    The archive is reproducible, i.e., it only depends on `files`: members are sorted, and all metadata is fixed
+    (mtime is _TAR_MTIME, or $SOURCE_DATE_EPOCH if set).
+    """
+    import tarfile
+    mtime = int(os.environ.get('SOURCE_DATE_EPOCH', _TAR_MTIME))
+    with tarfile.open(fileobj=fileobj, mode='w', format=tarfile.GNU_FORMAT) as tar:
+        for p, data in sorted(files.items()):
+            info = tarfile.TarInfo(p)
+            info.size = len(data)
+            info.mtime = mtime
+            info.mode = 0o644
+            info.uid = info.gid = 0
+            info.uname = info.gname = ''
+            tar.addfile(info, io.BytesIO(data))
+
+
+def _sha256_manifest(files):
+    """:return: manifest of dictionary {path -> bytes} `files`, in the format of `sha256sum`, sorted by path."""
+    return ''.join('{}  {}\n'.format(hashlib.sha256(data).hexdigest(), p) for p, data in sorted(files.items()))
+
+
+def test_write_tar_reproducible():
+    files = {'b/fig.pdf': b'pdf', 'a.tex': b'tex'}
+    tars = []
+    for files_in_order in (files, dict(reversed(list(files.items())))):
+        tar_bytes = io.BytesIO()
+        write_tar(files_in_order, tar_bytes)
+        tars.append(tar_bytes.getvalue())
+    assert tars[0] == tars[1]
+    assert _sha256_manifest(files).splitlines()[0] == hashlib.sha256(b'tex').hexdigest() + '  a.tex'
+
+
+# Service ----------------------------------------------------------------------
+
+
+class _TextCache(object):
+    """Thread-safe LRU cache {Storage.cache_key -> (text, encoding)} of decoded files, shared between Copiers."""
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class ServiceBusyException(Exception):
+    pass
+
+
+class PackagingService(object):
+    """Builds bundles for requests on a bounded pool of workers, keeping caches warm between requests.
+
+    Serve over HTTP with `serve`. POST /bundle with either
+    - a .zip or .tar(.gz) project archive as body, and the options as query parameters, or
+    - a JSON body (Content-Type: application/json) with the options, where main_file is a path on disk.
+    Options: main_file, encodings (comma separated in the query), rename, flatten.
+    The response is the bundle as (reproducible) tar, with metrics as JSON in the X-Arxiv-Prep-Metrics header.
+    """
+    def __init__(self, workers=2, max_pending=8, asset_cache=None, preamble_cache=None):
+        """
+        :param asset_cache: optional _AssetCache, shared by all requests.
+        :param preamble_cache: optional _PreambleCache, shared by all requests.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        # Requests that are running or waiting for a worker. More than that are rejected.
+        self._pending = threading.BoundedSemaphore(workers + max_pending)
+        self.text_cache = _TextCache()
+        self.asset_cache = asset_cache
+        self.preamble_cache = preamble_cache
+
+    def bundle(self, options, archive=None):
+        """
+        Run `_bundle` on a worker.
+        :raise ServiceBusyException if too many requests are pending.
+        """
+        if not self._pending.acquire(blocking=False):
+            raise ServiceBusyException('Too many pending requests.')
+        try:
+            return self._pool.submit(self._bundle, options, archive).result()
+        finally:
+            self._pending.release()
+
+    def _bundle(self, options, archive):
+        """:return: tuple (tar bytes, metrics dict)"""
+        start = time.perf_counter()
+        main_file = options['main_file']
+        if archive is not None:
+            archive_p = 'upload.zip' if archive.startswith(b'PK') else 'upload.tar'
+            prefix, main_file = os.path.split(_normpath(main_file))
+            src = ArchiveStorage(archive_p, prefix, fileobj=io.BytesIO(archive))
+        else:
+            src = LocalStorage(os.path.dirname(os.path.abspath(main_file)))
+            main_file = os.path.basename(main_file)
+        encodings = options.get('encodings') or ['utf-8']
+        hits_before = self.text_cache.hits
+        try:
+            bundle = build_bundle(src, main_file, encodings, rename=options.get('rename'),
+                                  flatten=bool(options.get('flatten')), text_cache=self.text_cache,
+                                  asset_cache=self.asset_cache, preamble_cache=self.preamble_cache)
+        finally:
+            src.close()
+        parsed = time.perf_counter()
+        tar = io.BytesIO()
+        write_tar(bundle.files, tar)
+        tar = tar.getvalue()
+        metrics = {
+            'main_file': bundle.main_file,
+            'num_files': len(bundle.files),
+            'files_bytes': sum(size for _, size in bundle.manifest),
+            'tar_bytes': len(tar),
+            'sha256': hashlib.sha256(tar).hexdigest(),
+            'parse_ms': round((parsed - start) * 1000, 1),
+            'tar_ms': round((time.perf_counter() - parsed) * 1000, 1),
+            'text_cache_hits': self.text_cache.hits - hits_before,
+        }
+        return tar, metrics
+
+    def serve(self, host='127.0.0.1', port=8765):
+        """Serve until interrupted."""
+        server = self.make_server(host, port)
+        print('*** Serving on http://{}:{}/bundle'.format(*server.server_address[:2]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.shutdown()
+
+    def make_server(self, host, port):
+        """:return: a ThreadingHTTPServer for this service. Use port 0 for a free port."""
+        import json
+        import tarfile
+        import zipfile
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from urllib.parse import parse_qs, urlsplit
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                url = urlsplit(self.path)
+                if url.path != '/bundle':
+                    return self._reply(404, b'Not found\n')
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    options, archive = json.loads(body.decode()), None
+                else:
+                    options = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                    if 'encodings' in options:
+                        options['encodings'] = options['encodings'].split(',')
+                    options['flatten'] = options.get('flatten', '') in ('1', 'true')
+                    archive = body
+                if 'main_file' not in options:
+                    return self._reply(400, b'main_file is required\n')
+                try:
+                    tar, metrics = service.bundle(options, archive)
+                except ServiceBusyException as e:
+                    return self._reply(503, str(e).encode() + b'\n')
+                except (ParseException, FileNotFoundError, ValueError, AssertionError, tarfile.TarError,
+                        zipfile.BadZipFile) as e:
+                    return self._reply(400, '{}: {}\n'.format(type(e).__name__, e).encode())
+                self._reply(200, tar, 'application/x-tar', {'X-Arxiv-Prep-Metrics': json.dumps(metrics)})
+
+            def _reply(self, code, body, content_type='text/plain', headers=None):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+        return ThreadingHTTPServer((host, port), Handler)
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+
+def test_packaging_service():
+    import json
+    import tarfile
+    import urllib.request
+    import zipfile
+    project = io.BytesIO()
+    with zipfile.ZipFile(project, 'w') as zf:
+        zf.writestr('paper/main.tex', '\\input{sec}\n\\includegraphics{fig}\n')
+        zf.writestr('paper/sec.tex', 'Sec % comment\n')
+        zf.writestr('paper/fig.png', 'png')
+        zf.writestr('paper/unused.png', 'unused')
+    service = PackagingService(workers=2)
+    server = service.make_server('127.0.0.1', 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = 'http://127.0.0.1:{}/bundle?main_file=paper/main.tex&rename=final'.format(server.server_address[1])
+        with urllib.request.urlopen(urllib.request.Request(url, data=project.getvalue())) as response:
+            metrics = json.loads(response.headers['X-Arxiv-Prep-Metrics'])
+            tar = response.read()
+        assert metrics['main_file'] == 'final.tex' and metrics['num_files'] == 3, metrics
+        assert metrics['sha256'] == hashlib.sha256(tar).hexdigest()
+        with tarfile.open(fileobj=io.BytesIO(tar)) as tf:
+            assert tf.getnames() == ['fig.png', 'final.tex', 'sec.tex']
+            assert tf.extractfile('sec.tex').read() == b'Sec\n'
+        # Uploading the same files again reuses the decoded files.
+        with urllib.request.urlopen(urllib.request.Request(url, data=project.getvalue())) as response:
+            hits = json.loads(response.headers['X-Arxiv-Prep-Metrics'])['text_cache_hits']
+        assert hits > metrics['text_cache_hits'], (hits, metrics)
+        for broken in (b'PK broken zip', b'broken tar'):
+            try:
+                urllib.request.urlopen(urllib.request.Request(url, data=broken))
+                assert False, broken
+            except urllib.error.HTTPError as e:
+                assert e.code == 400, (broken, e.code)
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.shutdown()
+
+
+def test_build_bundle():
+    src = MemoryStorage({'main.tex': b'\\input{sec/a}\n\\includegraphics{img/fig}\n',
+                         'sec/a.tex': b'A % comment\n',
+                         'img/fig.png': b'png',
+                         'img/unused.png': b'unused'})
+    bundle = build_bundle(src, 'main.tex', rename='paper')
+    assert bundle.main_file == 'paper.tex'
+    assert bundle.manifest == [('img/fig.png', 3), ('paper.tex', 40), ('sec/a.tex', 2)]
+    assert bundle.files['sec/a.tex'] == b'A\n'
+    tar_bytes = io.BytesIO()
+    write_tar(bundle.files, tar_bytes)
+    assert tar_bytes.getvalue()
+
+
+def test_build_variants():
+    src = MemoryStorage({'main.tex': b'\\newcommand{\\x}{x}\n\\input{body}\n\\begin{supp}\n\\input{supp_body}\n'
+                                     b'\\end{supp}\nEnd\n',
+                         'supp.tex': b'\\newcommand{\\x}{x}\n\\input{macros}\n\\input{supp_body}\n\\fig{b}\n',
+                         'body.tex': b'\\input{macros}\n\\includegraphics{fig}\n',
+                         'macros.tex': b'\\newcommand{\\fig}[1]{\\includegraphics{figs/#1}}\n',
+                         'supp_body.tex': b'\\includegraphics{supp_fig}\n',
+                         'fig.pdf': b'fig', 'supp_fig.pdf': b'supp_fig', 'figs/b.pdf': b'b'})
+    parsed = []
+    c = Copier(['utf-8'], 'main.tex', src=src, dst=MemoryStorage())
+    c._parse_lines = lambda p, *args, parse=c._parse_lines: parsed.append(p) or parse(p, *args)
+    bundles = {}
+    for variant in (Variant('arxiv', 'main.tex'), Variant('camera_ready', 'main.tex', strip_envs=['supp']),
+                    Variant('supplement', 'supp.tex', rename='supplement')):
+        dst = MemoryStorage()
+        bundles[variant.name] = c.copy_variant(variant, dst), dst
+    assert sorted(parsed) == ['body.tex', 'macros.tex', 'main.tex', 'supp.tex', 'supp_body.tex']
+    assert bundles['arxiv'][0][1] == ['body.tex', 'fig.pdf', 'macros.tex', 'main.tex', 'supp_body.tex',
+                                      'supp_fig.pdf']
+    assert bundles['camera_ready'][0][1] == ['body.tex', 'fig.pdf', 'macros.tex', 'main.tex']
+    assert bundles['camera_ready'][1].read('main.tex') == b'\\newcommand{\\x}{x}\n\\input{body}\nEnd\n'
+    # macros.tex is only parsed for main.tex, but its definitions are used by supp.tex, too.
+    assert bundles['supplement'][0] == ('supplement.tex', ['figs/b.pdf', 'macros.tex', 'supp_body.tex',
+                                                           'supp_fig.pdf', 'supplement.tex'])
+    assert sorted(build_bundle(src, 'supp.tex').files) == ['figs/b.pdf', 'macros.tex', 'supp.tex', 'supp_body.tex',
+                                                           'supp_fig.pdf']
+
+
+
+def test_parse_once():
+    src = MemoryStorage({'main.tex': b'\\usepackage{a}\n\\input{sec}\n\\input{sec}\n\\usepackage{b}\n',
+                         'sec.tex': b'\\includegraphics{fig}\n',
+                         'a.sty': b'\\usepackage{b}\n', 'b.sty': b'\\usepackage{a}\n',
+                         'fig.pdf': b'fig'})
+    parsed = []
+    c = Copier(['utf-8'], 'main.tex', src=src, dst=MemoryStorage())
+    c._parse_lines = lambda p, *args, parse=c._parse_lines: parsed.append(p) or parse(p, *args)
+    c.copy_to_dst()
+    assert parsed == ['main.tex', 'a.sty', 'b.sty', 'sec.tex']
+    assert c.copied_files() == ['a.sty', 'b.sty', 'fig.pdf', 'main.tex', 'sec.tex']
+
+
+    src.write('sec.tex', b'\\input{sub/loop}\n')
+    src.write('sub/loop.tex', b'\\input{sec}\n')
+    c = Copier(['utf-8'], 'main.tex', src=src, dst=MemoryStorage())
+    try:
+        c.copy_to_dst()
+        assert False, 'Expected ParseException'
+    except ParseException as e:
+        assert str(e) == 'Include cycle: main.tex -> sec.tex -> sub/loop.tex -> sec.tex'
+
+    # Every file is written once, even if it is included many times.
+    src.write('main.tex', b'\\input{figs}\n' * 50)
+    src.write('figs.tex', b''.join(b'\\includegraphics{fig%d}\n' % i for i in range(20)))
+    for i in range(20):
+        src.write('fig%d.pdf' % i, b'fig')
+    written = []
+    dst = MemoryStorage()
+    dst.write = lambda p, data, write=dst.write: written.append(p) or write(p, data)
+    c = Copier(['utf-8'], 'main.tex', src=src, dst=dst)
+    c.copy_to_dst()
+    assert sorted(written) == c.copied_files() and len(written) == 22
+
+
+
+def test_parse_parallel():
+    # \z is only defined after x.tex is included.
+    files = {'main.tex': b'\\input{x}\n\\newcommand{\\z}{\\includegraphics{zfig}}\n'
+                         b'\\newcommand{\\sec}[1]{\\input{sections/#1}}\n\\usepackage{macros}\n'
+                         b'\\newcommand{\\fig}[1]{\\includegraphics{figs/#1}}\n' +
+                         b''.join(b'\\sec{s%d}\n' % i for i in range(20)) +
+                         b'\\input{late}\n\\sub\n\\renewcommand{\\sub}{\\input{b}}\n\\sub\n',
+             'macros.sty': b'\\RequirePackage{xcolor}\n',
+             # \sub is defined in an included file, \later only after it is used.
+             'late.tex': b'\\later\n\\newcommand{\\later}{\\fig{late}}\n\\newcommand{\\sub}{\\input{a}}\n',
+             'a.tex': b'\\fig{a}\n', 'b.tex': b'\\fig{b}\n', 'x.tex': b'\\z\n',
+             'figs/late.pdf': b'late', 'figs/a.pdf': b'a', 'figs/b.pdf': b'b', 'zfig.pdf': b'z'}
+    for i in range(20):
+        files['sections/s%d.tex' % i] = b'\\section{S%d}\n\\fig{f%d}\n' % (i, i)
+        files['figs/f%d.pdf' % i] = b'f%d' % i
+    src = MemoryStorage(files)
+    sequential = build_bundle(src, 'main.tex')
+    parallel = build_bundle(src, 'main.tex', parse_workers=2)  # With more than one file per chunk of pool.map.
+    assert parallel.files == sequential.files
+    assert {'a.tex', 'b.tex', 'figs/a.pdf', 'figs/b.pdf'} <= set(parallel.files)
+    assert 'figs/late.pdf' not in parallel.files and 'zfig.pdf' not in parallel.files
+
+
+def test_preamble_cache():
+    import tempfile
+    src = MemoryStorage({'main.tex': b'\\documentclass{article}\n\\usepackage{local}\n\\input{macros}\n'
+                                     b'\\begin{document}\n\\fig{a}\n\\end{document}\n',
+                         'macros.tex': b'\\newcommand{\\fig}[1]{\\includegraphics{figs/#1}}\n',
+                         'local.sty': b'\\usepackage{xcolor}\n', 'figs/a.pdf': b'a', 'figs/b.pdf': b'b'})
+    with tempfile.TemporaryDirectory() as d:
+        bundles, parsed = [], []
+        for _ in range(2):
+            c = Copier(['utf-8'], 'main.tex', src=src, dst=MemoryStorage(), preamble_cache=_PreambleCache(d))
+            c._parse_lines = lambda p, *args, parse=c._parse_lines: parsed.append(p) or parse(p, *args)
+            c.copy_to_dst()
+            bundles.append({p: c.dst.read(p) for p in c.copied_files()})
+        assert parsed == ['main.tex', 'local.sty', 'macros.tex', 'main.tex']
+        assert bundles[0] == bundles[1] and sorted(bundles[1]) == ['figs/a.pdf', 'local.sty', 'macros.tex', 'main.tex']
+        # Changing an included file invalidates the snapshot.
+        src.write('macros.tex', b'\\newcommand{\\fig}[1]{\\includegraphics{figs/b}}\n')
+        bundle = build_bundle(src, 'main.tex', preamble_cache=_PreambleCache(d))
+        assert sorted(bundle.files) == ['figs/b.pdf', 'local.sty', 'macros.tex', 'main.tex']
+        # So does adding a missing optional include, or another file matching an include without extension.
+        src.write('main.tex', b'\\usepackage{mystyle}\n\\includegraphics{logo}\n\\begin{document}\n\\end{document}\n')
+        src.write('logo.png', b'png')
+        assert sorted(build_bundle(src, 'main.tex', preamble_cache=_PreambleCache(d)).files) == ['logo.png', 'main.tex']
+        src.write('mystyle.sty', b'\\input{macros}\n')
+        bundle = build_bundle(src, 'main.tex', preamble_cache=_PreambleCache(d))
+        assert sorted(bundle.files) == ['logo.png', 'macros.tex', 'main.tex', 'mystyle.sty']
+        src.rename('logo.png', 'logo.pdf')
+        bundle = build_bundle(src, 'main.tex', preamble_cache=_PreambleCache(d))
+        assert sorted(bundle.files) == ['logo.pdf', 'macros.tex', 'main.tex', 'mystyle.sty']
+        # Unreadable snapshots are ignored.
+        for p in glob.glob(os.path.join(d, '*.json')):
+            with open(p, 'w') as f:
+                f.write('{"files": {}')
+        bundle = build_bundle(src, 'main.tex', preamble_cache=_PreambleCache(d))
+        assert sorted(bundle.files) == ['logo.pdf', 'macros.tex', 'main.tex', 'mystyle.sty']
+
+
 def _note_on_extensions(real_path, expected_extensions):
     pass
 
@@ -466,6 +2926,83 @@ def test_dirs():
     assert c.tex_root_dir == os.getcwd()
 
 
+def test_flatten():
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        os.makedirs(os.path.join(d, 'in', 'sec'))
+        os.makedirs(os.path.join(d, 'out'))
+        files = {'main.tex': 'A % comment\nBefore \\input{sec/a} after.\n\\subfile{sec/b}\n\\end{document}\n',
+                 'sec/a.tex': '% only comment\nInput\n',
+                 'sec/b.tex': 'preamble\n\\begin{document}\nSubfile\n\\end{document}\n'}
+        for p, content in files.items():
+            with open(os.path.join(d, 'in', p), 'w') as f:
+                f.write(content)
+        c = Copier(['utf-8'], os.path.join(d, 'in', 'main.tex'), os.path.join(d, 'out'))
+        main_file_out = c.copy(flatten=True)
+        with open(main_file_out) as f:
+            assert f.read() == 'A\nBefore %\nInput\n after.\nSubfile\n\\end{document}\n\n'
+        assert os.listdir(os.path.join(d, 'out')) == ['main.tex']
+    # The encoding of the main file is kept. ASCII files can be inlined into any of them, other files must match.
+    src = MemoryStorage({'main.tex': '\\usepackage[latin1]{inputenc}\n\u00e4\n\\input{a}\n'.encode('latin-1'),
+                         'a.tex': b'ASCII\n', 'b.tex': '\u00e4\n'.encode('utf-8')})
+    bundle = build_bundle(src, 'main.tex', ['utf-8', 'latin-1'], flatten=True)
+    assert bundle.files['main.tex'] == '\\usepackage[latin1]{inputenc}\n\u00e4\nASCII\n'.encode('latin-1')
+    src.write('a.tex', b'\\input{b}\n')
+    try:
+        build_bundle(src, 'main.tex', ['utf-8', 'latin-1'], flatten=True)
+        assert False
+    except ParseException as e:
+        assert 'b.tex (utf-8)' in str(e), e
+
+
+# Lazily imported modules, which should not be loaded for `--help`.
+_LAZY_MODULES = ('fjcommon', 'PIL', 'tempfile', 'concurrent.futures')
+# Budget for `python -X importtime -c "import main2"`, cumulative, in milliseconds.
+_IMPORT_TIME_BUDGET_MS = 100
+# Budget for the wall time of `arxiv_prep --help`, on top of starting the interpreter, in milliseconds.
+_HELP_TIME_BUDGET_MS = 150
+_HELP_CODE = 'import main2\ntry:\n    main2.main(["--help"])\nexcept SystemExit:\n    pass'
+
+
+def _import_times_us(code, cwd):
+    """:return: dictionary {module -> cumulative import time in us} for running `code` in a fresh interpreter."""
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], stderr=subprocess.PIPE,
+                         stdout=subprocess.DEVNULL, cwd=cwd, check=True)
+    times = {}
+    for line in out.stderr.decode().splitlines():
+        # Format: "import time: self [us] | cumulative | imported package"
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line.split('|')
+        times[module.strip()] = int(cumulative)
+    return times
+
+
+def _run_time_ms(code, cwd, repeat=3):
+    """:return: the shortest wall time of `repeat` runs of `code` in a fresh interpreter, in milliseconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], stdout=subprocess.DEVNULL, cwd=cwd, check=True)
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def test_startup_time():
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        # Measure a copy with up-to-date bytecode, as an installed package would have, without writing bytecode to
+        # the source tree.
+        shutil.copy(os.path.abspath(__file__), d)
+        subprocess.run([sys.executable, '-m', 'compileall', '-q', d], check=True)
+        times = _import_times_us('import main2', d)
+        assert times['main2'] < _IMPORT_TIME_BUDGET_MS * 1000, 'import main2 took {}ms'.format(times['main2'] / 1000)
+        times = _import_times_us(_HELP_CODE, d)
+        assert not any(m.startswith(_LAZY_MODULES) for m in times), [m for m in times if m.startswith(_LAZY_MODULES)]
+        help_ms = _run_time_ms(_HELP_CODE, d) - _run_time_ms('pass', d)
+        assert help_ms < _HELP_TIME_BUDGET_MS, '--help took {:.1f}ms'.format(help_ms)
+
+
 # Strip Comments ---------------------------------------------------------------
 
 
@@ -521,56 +3058,102 @@ def test_strip():
 
 
 # TODO
-def strip_comments(p):
+def strip_comments(p, encoding='utf-8'):
     """ Remove unneeded comments from LaTeX file `p`. """
-    with _modify_file(p) as (fin, fout):
-        # strip comments
-        l_prev = None
-        for l in fin.readlines():
-            l = strip_comments_from_line(l, l_prev)
-            if not l:
-                continue
-            l_prev = l
-            fout.write(l)
-            if _END_DOCUMENT_MARKER in l:
-                print('Reached {}, stopping...'.format(l.strip()))
-                fout.write('\n')
-                break
+    with _modify_file(p, encoding) as (fin, fout):
+        fout.writelines(_strip_comments_from_lines(fin))
+
+
+def _strip_comments_from_lines(lines):
+    """ Yield the lines of `lines` that are needed, with comments removed. Stops after \\end{document}. """
+    l_prev = None
+    for l in lines:
+        l = strip_comments_from_line(l, l_prev)
+        if not l:
+            continue
+        l_prev = l
+        yield l
+        if _END_DOCUMENT_MARKER in l:
+            print('Reached {}, stopping...'.format(l.strip()))
+            yield '\n'
+            break
 
 
-@contextmanager
-def _open(p, encodings):
-    for enc in encodings:
+# Byte order marks, UTF-32 first since BOM_UTF32_LE starts with BOM_UTF16_LE.
+_BOMS = [
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+
+def _without_bom(encoding):
+    """:return: `encoding`, without writing a byte order mark for UTF-8."""
+    return 'utf-8' if encoding == 'utf-8-sig' else encoding
+
+
+def _decode_text(data, p, encodings, detected_encodings=None):
+    """
+    Decode the contents `data` of file `p` in memory with the encoding detected by `_detect_encoding`.
+    :param detected_encodings: optional dictionary {p -> encoding}, used as a cache.
+    :return: tuple (text, encoding)
+    """
+    encoding = detected_encodings.get(p) if detected_encodings is not None else None
+    if encoding is None:
+        encoding = _detect_encoding(data, encodings, p)
+        if detected_encodings is not None:
+            detected_encodings[p] = encoding
+    return data.decode(encoding), encoding
+
+
+def _detect_encoding(data, encodings, p=''):
+    """
+    Detect encoding of the bytes `data`: check for a BOM, then for valid UTF-8, then try `encodings` in order.
+    :raise ParseException if none of the encodings can decode `data`.
+    """
+    for bom, encoding in _BOMS:
+        if data.startswith(bom):
+            return encoding
+    for encoding in ['utf-8'] + [enc for enc in encodings if codecs.lookup(enc).name != 'utf-8']:
         try:
-            f = open(p, 'r', encoding=enc)
-            yield f
-            f.close()
-            break
+            data.decode(encoding)
+            return encoding
         except UnicodeDecodeError as e:
-            print('Error while reading {} with {}: {}'.format(p, enc, e))
+            print('Error while reading {} with {}: {}'.format(p, encoding, e))
+    raise ParseException('Unable to read {} with encodings {}. Pass --encodings'.format(p, encodings))
+
+
+def test_detect_encoding():
+    assert _detect_encoding('\u00e4'.encode('utf-8'), ['latin-1']) == 'utf-8'
+    assert _detect_encoding('\u00e4'.encode('latin-1'), ['latin-1']) == 'latin-1'
+    assert _detect_encoding(codecs.BOM_UTF8 + b'a', []) == 'utf-8-sig'
+    assert _detect_encoding('a'.encode('utf-16'), []) == 'utf-16'
+    try:
+        _detect_encoding('\u00e4'.encode('latin-1'), ['utf-8'])
+        assert False
+    except ParseException:
+        pass
 
 
 @contextmanager
-def _modify_file(p, out_encoding='utf-8'):
+def _modify_file(p, encoding='utf-8'):
     p_tmp = p + '_tmp'
     assert not os.path.isfile(p_tmp)
-    with open(p, 'r') as fin:
-        with open(p_tmp, 'w', encoding=out_encoding) as fout:
+    with open(p, 'r', encoding=encoding) as fin:
+        with open(p_tmp, 'w', encoding=encoding) as fout:
             yield fin, fout
     os.rename(p_tmp, p)
 
 
-
-def _insert_in_file(p, text):
-    with _modify_file(p) as (fin, fout):
-        fout.write(text.rstrip() + '\n' + fin.read())
-
-
 def main(args=sys.argv[1:]):
     p = argparse.ArgumentParser()
-    p.add_argument('main_file')
+    p.add_argument('main_file', nargs='?', help='Main LaTeX file. May also be inside a .zip or .tar(.gz) archive, '
+                                      'e.g., paper.zip/main.tex.')
     p.add_argument('--out_dir', '-o', help='Where to store files. By default, create a directory above input.')
-    p.add_argument('--encodings', default=['utf-8'], nargs='+', help='Encodings to try when opening .tex files')
+    p.add_argument('--encodings', default=['utf-8'], nargs='+',
+                   help='Encodings to try when opening .tex files, after checking for a BOM and UTF-8.')
     p.add_argument('--force', '-f', action='store_true', help='If given, delete and re-create OUT_DIR. '
                                                               'WARNING: Calls rm -rf OUT_DIR.')
     p.add_argument('--store_git_hash', '-git', action='store_true',
@@ -581,10 +3164,74 @@ def main(args=sys.argv[1:]):
 
     p.add_argument('--rename', '-mv',
                    help='If given, rename OUT_DIR/MAIN_FILE to OUT_DIR/NEW_NAME', metavar='NEW_NAME')
+    p.add_argument('--flatten', action='store_true',
+                   help='If given, expand all .tex files included via \\input or \\subfile in place, and write a '
+                        'single OUT_DIR/MAIN_FILE. Other files (.sty, .bib, images) are copied as usual.')
+    p.add_argument('--parse_workers', type=int, default=1,
+                   help='If > 1, first collect the \\newcommand definitions in one pass, then parse the .tex files on '
+                        'PARSE_WORKERS processes. The result is the same as without. Ignored with --flatten, and '
+                        '--preamble_cache is not used then.')
+    p.add_argument('--git_rev', metavar='REV',
+                   help='If given, read all sources from commit REV of the git repository GIT_REPO, without a '
+                        'checkout. MAIN_FILE is then relative to the root of the repository.')
+    p.add_argument('--git_repo', default='.', help='Repository used with --git_rev.')
+    p.add_argument('--extract_pdf_pages', action='store_true',
+                   help='If given, only keep the pages of included PDFs that are used via \\includegraphics[page=N], '
+                        'and update the page options. Needs pypdf.')
+    p.add_argument('--optimize_pdfs', nargs='?', type=int, const=300, metavar='MAX_DPI',
+                   help='If given, optimize all PDFs on a process pool: compress content streams, downsample images '
+                        'above MAX_DPI at the size they are drawn at (default: 300, needs Pillow), and remove unused '
+                        'objects and metadata. A PDF is only replaced if it gets smaller. Needs pypdf.')
+    p.add_argument('--asset_cache', nargs='?', const=_ASSET_CACHE_DIR, metavar='CACHE_DIR',
+                   help='If given, cache converted images and reduced PDFs in CACHE_DIR (default: {}), keyed by their '
+                        'contents and the conversion settings, and reuse them in later runs.'.format(_ASSET_CACHE_DIR))
+    p.add_argument('--asset_cache_mb', type=int, default=_ASSET_CACHE_MAX_MB,
+                   help='Maximum size of the --asset_cache. The least recently used files are removed first.')
+    p.add_argument('--preamble_cache', nargs='?', const=_PREAMBLE_CACHE_DIR, metavar='CACHE_DIR',
+                   help='If given, save the definitions of the preamble to CACHE_DIR (default: {}), and reuse them '
+                        'as long as the preamble and the files it includes do not change.'.format(_PREAMBLE_CACHE_DIR))
+    p.add_argument('--variants', metavar='VARIANTS_JSON',
+                   help='If given, build several bundles from a single parse. VARIANTS_JSON contains a list of '
+                        'objects with keys name, main_file (relative to the directory of MAIN_FILE), and optionally '
+                        'strip_envs, jpg_exts, jpg_quality, rename. Every variant is written to OUT_DIR/NAME.')
+    p.add_argument('--serve', metavar='[HOST:]PORT',
+                   help='If given, run a local packaging service on HOST:PORT instead (default host: 127.0.0.1). '
+                        'See PackagingService for the API.')
+    p.add_argument('--workers', type=int, default=2, help='Number of parallel builds with --serve.')
+    p.add_argument('--fmt_cache', nargs='?', const=_FMT_CACHE_DIR, metavar='CACHE_DIR',
+                   help='If given, precompile the preamble into a format with mylatexformat, cache it in CACHE_DIR '
+                        '(default: {}), and use it for the verification compile.'.format(_FMT_CACHE_DIR))
+    p.add_argument('--verify', action='store_true',
+                   help='If given, compile the original tree and OUT_DIR in parallel, and compare page counts, text '
+                        'of every page (needs pdftotext), and numbers of warnings and undefined references.')
+    p.add_argument('--compile_timeout', type=float, metavar='SECONDS',
+                   help='If given, stop compiling after SECONDS. Compiling always stops early on fatal errors, such '
+                        'as missing files.')
+    p.add_argument('--fmt_engine', default='pdflatex', help='Engine used to dump and load formats for --fmt_cache.')
     flags = p.parse_args(args)
 
+    if flags.serve:
+        host, _, port = flags.serve.rpartition(':')
+        asset_cache = _AssetCache(flags.asset_cache, flags.asset_cache_mb * 1024 * 1024) if flags.asset_cache else None
+        preamble_cache = _PreambleCache(flags.preamble_cache) if flags.preamble_cache else None
+        PackagingService(flags.workers, asset_cache=asset_cache,
+                         preamble_cache=preamble_cache).serve(host or '127.0.0.1', int(port))
+        return
+    if flags.main_file is None:
+        p.error('the following arguments are required: main_file')
+    if flags.variants:
+        # Variants have their own rename, and are built with copy_variant, which does not support these.
+        unsupported = [flag for flag, value in (('--rename', flags.rename), ('--flatten', flags.flatten),
+                                                ('--extract_pdf_pages', flags.extract_pdf_pages),
+                                                ('--optimize_pdfs', flags.optimize_pdfs),
+                                                ('--parse_workers', flags.parse_workers > 1),
+                                                ('--store_git_hash', flags.store_git_hash)) if value]
+        if unsupported:
+            p.error('{} cannot be combined with --variants'.format(', '.join(unsupported)))
+
     if flags.out_dir is None:
-        flags.out_dir = os.path.dirname(os.path.abspath(flags.main_file)) + '_arXivout'
+        main_file = os.path.join(flags.git_repo, flags.main_file) if flags.git_rev else flags.main_file
+        flags.out_dir = os.path.dirname(os.path.abspath(main_file)) + '_arXivout'
 
     if os.path.isdir(flags.out_dir):
         print(f'*** OUT_DIR={flags.out_dir} exists! Delete or pass -f.')